@@ -0,0 +1,78 @@
+import json
+import os
+import threading
+from serial.tools import list_ports
+from port_watcher import usb_identity
+
+AUTO_BAUD = 'Auto'
+# rates tried above the ROM's 115200, in ramp-up order
+BAUD_STEPS = [115200, 230400, 460800, 921600, 1500000, 2000000]
+
+
+def is_auto(baud):
+    return str(baud).lower() == AUTO_BAUD.lower()
+
+
+def lower_step(baud):
+    lower = [step for step in BAUD_STEPS if step < baud]
+    return lower[-1] if lower else None
+
+
+def port_identity(port):
+    # the USB bridge (VID:PID plus serial number or hub location) rather than
+    # the port name, which changes when boards are replugged
+    for info in list_ports.comports():
+        if info.device == port:
+            return usb_identity(info)
+    return port
+
+
+class BaudMemory:
+    # best working baud per bridge identity, kept in a JSON file if open()ed
+    def __init__(self):
+        self.path = None
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        with self._lock:
+            self.path = path
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r') as f:
+                        self._rates = json.load(f)
+                except (ValueError, OSError) as e:
+                    # rates are only a head start, the ramp-up finds them again
+                    print('Ignoring damaged baud file {} ({})'.format(path, e))
+                    self._rates = {}
+
+    def _save(self):
+        # written after every board, a crash mid-write must not lose the file
+        if self.path is not None:
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self._rates, f)
+            os.replace(temp, self.path)
+
+    def best(self, identity):
+        with self._lock:
+            entry = self._rates.get(identity)
+            return entry['baud'] if entry else None
+
+    def record_success(self, identity, baud, rate):
+        with self._lock:
+            entry = self._rates.setdefault(identity, {'baud': baud, 'rate': 0, 'failures': 0})
+            entry['baud'] = baud
+            entry['rate'] = int(rate)
+            self._save()
+
+    def record_failure(self, identity, baud):
+        # next board on this bridge starts one step lower
+        with self._lock:
+            entry = self._rates.setdefault(identity, {'baud': baud, 'rate': 0, 'failures': 0})
+            entry['baud'] = lower_step(baud) or baud
+            entry['failures'] += 1
+            self._save()
+
+
+baud_memory = BaudMemory()
@@ -0,0 +1,145 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from config_file import FlashConfig
+from fake_esp import FakeEsp
+from gang_flasher import GangFlasher, PortResult, backend_flash_func
+from timing import station_timings, quantile
+
+# flashes simulated boards (fake_esp) in parallel, no hardware needed:
+#
+#   python benchmark.py --boards 32 --workers 8 --size 1024 --realtime
+#   python benchmark.py --scaling --boards 32     (threads vs. processes, 1 to 32 ports)
+#
+# exits 1 if a board failed or its flash doesn't hold the image afterwards
+
+# the simulated boards run in their own processes, this many per process,
+# so they don't compete with the flasher under test for the GIL
+BOARDS_PER_FARM = 8
+
+
+def _farm(conn, chip, count, seed, options):
+    devices = [FakeEsp(chip, seed=seed + i, **options).start() for i in range(count)]
+    conn.send([device.port for device in devices])
+    # asked for the digest of the first length bytes of flash when flashing is over
+    length = conn.recv()
+    conn.send([hashlib.md5(bytes(device.flash[:length])).hexdigest() for device in devices])
+    for device in devices:
+        device.stop()
+
+
+def start_boards(chip, boards, seed, **options):
+    # -> [(pipe, process)] and the ports of all boards
+    context = multiprocessing.get_context('spawn')
+    farms = []
+    ports = []
+    for first in range(0, boards, BOARDS_PER_FARM):
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_farm, daemon=True,
+                                  args=(child_conn, chip, min(BOARDS_PER_FARM, boards - first), seed + first, options))
+        process.start()
+        farms.append((parent_conn, process))
+    for parent_conn, _ in farms:
+        ports += parent_conn.recv()
+    return farms, ports
+
+
+def stop_boards(farms, length):
+    # -> flash digest of every board
+    digests = []
+    for parent_conn, process in farms:
+        parent_conn.send(length)
+        digests += parent_conn.recv()
+        process.join()
+    return digests
+
+
+def run(boards=8, workers=4, size_kb=512, chip='ESP32', baud='921600', latency=0.0, realtime=False,
+        max_baud=921600, error_rate=0.0, verify='hash', seed=1, backend='Threads', quiet=False):
+    # -> (all boards passed and hold the image, wall seconds)
+    firmware = os.urandom(size_kb * 1024 // 2) + b'\xff' * (size_kb * 1024 // 2)
+    with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+        f.write(firmware)
+    config = FlashConfig()
+    config.firmware_path = f.name
+    config.baud = baud
+    config.verify = verify
+    config.gang_backend = backend
+    config.before = config.after = 'no_reset'
+    farms, ports = start_boards(chip, boards, seed, latency=latency, realtime=realtime, max_baud=max_baud,
+                                error_rate=error_rate)
+    station_timings.reset()
+    try:
+        start = time.perf_counter()
+        gang = GangFlasher(config, ports, max_workers=workers, flash_func=backend_flash_func(config))
+        gang.run()
+        elapsed = time.perf_counter() - start
+    finally:
+        digests = stop_boards(farms, len(firmware))
+        os.remove(f.name)
+    intact = [digest == hashlib.md5(firmware).hexdigest() for digest in digests]
+
+    passed = sum(1 for result in gang.results if result.status == PortResult.PASS)
+    ok = passed == boards and all(intact)
+    if quiet:
+        return ok, elapsed
+    totals = sorted(span.seconds for span in station_timings.spans() if span.phase == 'total')
+    print('{} boards, {} workers ({}), {} kB {}: {} passed, {} intact'.format(
+        boards, workers, backend.lower(), size_kb, chip, passed, sum(intact)))
+    print('wall {:.2f} s, {:.1f} boards/s, {:.0f} units/h, {:.1f} kB/s image data'.format(
+        elapsed, boards / elapsed, boards * 3600 / elapsed, boards * len(firmware) / elapsed / 1000))
+    print('per board p50 {:.3f} s, p90 {:.3f} s, p99 {:.3f} s, max {:.3f} s'.format(
+        quantile(totals, 0.5), quantile(totals, 0.9), quantile(totals, 0.99), totals[-1] if totals else 0))
+    print(station_timings.report())
+    for result in gang.results:
+        if result.status == PortResult.FAIL:
+            print('{}: {}'.format(result.port, result.error))
+    return ok, elapsed
+
+
+def scaling(max_ports=32, size_kb=512, **options):
+    # every port count with one worker per port, on both backends
+    counts = [count for count in [1, 2, 4, 8, 16, 32, 64] if count <= max_ports]
+    print('{:<10}{:>6}{:>9}{:>11}{:>15}'.format('backend', 'ports', 'wall s', 'boards/s', 'kB/s per port'))
+    ok = True
+    for backend in ['Threads', 'Processes']:
+        for count in counts:
+            passed, elapsed = run(count, count, size_kb, backend=backend, quiet=True, **options)
+            ok = ok and passed
+            print('{:<10}{:>6}{:>9.2f}{:>11.2f}{:>15.1f}{}'.format(
+                backend.lower(), count, elapsed, count / elapsed, size_kb / elapsed, '' if passed else '  FAILED'))
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Parallel flashing benchmark on simulated boards')
+    parser.add_argument('--boards', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--size', type=int, default=512, help='image size in kB, half of it 0xFF')
+    parser.add_argument('--chip', choices=['ESP32', 'ESP8266'], default='ESP32')
+    parser.add_argument('--baud', default='921600')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every command')
+    parser.add_argument('--realtime', action='store_true', help='pace the simulated UART at the line baud')
+    parser.add_argument('--max-baud', type=int, default=921600)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of data blocks failing')
+    parser.add_argument('--verify', choices=['hash', 'paranoid'], default='hash')
+    parser.add_argument('--processes', action='store_true', help='flash every port in its own worker process')
+    parser.add_argument('--scaling', action='store_true',
+                        help='threads and processes with 1 port up to --boards ports, one worker per port')
+    args = parser.parse_args(argv)
+    if args.scaling:
+        ok = scaling(args.boards, args.size, chip=args.chip, baud=args.baud, latency=args.latency,
+                     realtime=args.realtime, max_baud=args.max_baud, error_rate=args.error_rate,
+                     verify=args.verify)
+        return 0 if ok else 1
+    ok, _ = run(args.boards, args.workers, args.size, args.chip, args.baud, args.latency, args.realtime,
+                args.max_baud, args.error_rate, args.verify, backend='Processes' if args.processes else 'Threads')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
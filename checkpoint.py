@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+
+# a large image is written in pieces of this size, each confirmed one is
+# recorded so a board that drops off the bus resumes after it
+RESUME_CHUNK_SIZE = 0x40000
+
+
+def firmware_key(segments):
+    # [(address, FirmwareImage)] -> identifies the firmware of an attempt
+    return ','.join('{:x}:{}'.format(address, image.md5) for address, image in segments)
+
+
+class CheckpointStore:
+    # confirmed write progress per board MAC, kept in a JSON file if open()ed:
+    # {mac: {'firmware': key, 'erased': bool, 'segments': {address: [image md5, confirmed bytes]}}}
+    def __init__(self):
+        self.path = None
+        self._boards = {}
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        with self._lock:
+            self.path = path
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r') as f:
+                        self._boards = json.load(f)
+                except ValueError:
+                    print('Ignoring damaged checkpoint file {}'.format(path))
+
+    def _save(self):
+        # written after every chunk, a crash mid-write must not lose the file
+        if self.path is not None:
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self._boards, f)
+            os.replace(temp, self.path)
+
+    def get(self, mac, key):
+        # the board's checkpoint if it was for the same firmware
+        with self._lock:
+            entry = self._boards.get(mac)
+            return dict(entry) if entry and entry['firmware'] == key else None
+
+    def start(self, mac, key, erased):
+        # a new attempt; progress of another firmware on this board is dropped
+        with self._lock:
+            entry = self._boards.get(mac)
+            if not entry or entry['firmware'] != key:
+                self._boards[mac] = {'firmware': key, 'erased': erased, 'segments': {}, 'time': time.time()}
+            else:
+                entry['erased'] = entry['erased'] or erased
+            self._save()
+
+    def has(self, mac):
+        with self._lock:
+            return bool(self._boards.get(mac, {}).get('segments'))
+
+    def confirmed(self, mac, address, md5):
+        with self._lock:
+            entry = self._boards.get(mac)
+            if entry is None:
+                return 0
+            saved_md5, size = entry['segments'].get(str(address), (None, 0))
+            return size if saved_md5 == md5 else 0
+
+    def confirm(self, mac, address, md5, size):
+        with self._lock:
+            entry = self._boards.get(mac)
+            if entry is not None:
+                entry['segments'][str(address)] = [md5, size]
+                entry['time'] = time.time()
+                self._save()
+
+    def clear(self, mac):
+        with self._lock:
+            if self._boards.pop(mac, None) is not None:
+                self._save()
+
+
+checkpoints = CheckpointStore()
@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config_file import FlashConfig, get_baud_file_path, get_checkpoint_file_path
+from baud_tuner import baud_memory
+from checkpoint import checkpoints
+from flasher import Espflasher
+from flash_session import FlashSession
+from gang_flasher import GangFlasher, PortResult, backend_flash_func
+from manifest import Manifest
+from output_router import set_default_output
+from port_watcher import PortWatcher
+from timing import station_timings
+from unit_history import unit_history
+
+# headless entry point: one JSON object per line on stdout, esptool output on
+# stderr; never imports wx
+#
+#   python cli.py flash firmware.bin --port /dev/ttyUSB0 --port /dev/ttyUSB1
+#   python cli.py read-mac --port /dev/ttyUSB0
+#   python cli.py harvest --port /dev/ttyUSB0 --port /dev/ttyUSB1
+#   python cli.py history --mac 24:0a:c4:12:34:56
+#   python cli.py ports
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+class JsonLines:
+    # worker threads emit concurrently, every event is one whole line
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        line = json.dumps(dict(event=event, time=round(time.time(), 3), **fields))
+        with self._lock:
+            self._stream.write(line + '\n')
+            self._stream.flush()
+
+
+def make_config(args):
+    # saved GUI settings, overridden by the command line
+    config = FlashConfig.load()
+    config.firmware_path = getattr(args, 'firmware', None)
+    if args.baud:
+        config.baud = args.baud
+    if getattr(args, 'mode', None):
+        config.mode = args.mode
+    if getattr(args, 'erase', False):
+        config.erase_flash = "Yes"
+    if getattr(args, 'diff', False):
+        config.diff_flash = "Yes"
+    if getattr(args, 'verify', None):
+        config.verify = args.verify
+    if getattr(args, 'processes', False):
+        config.gang_backend = 'Processes'
+    if getattr(args, 'no_resume', False):
+        config.resume = "No"
+    if getattr(args, 'before', None):
+        config.before = args.before
+    if getattr(args, 'after', None):
+        config.after = args.after
+    return config
+
+
+def open_records(path):
+    # imported here, the workbook library is only needed when records are kept
+    from to_excel import Excel
+    # None: the store the GUI saves to
+    Excel.store_path = path
+    return Excel()
+
+
+def cmd_flash(args, out):
+    config = make_config(args)
+    try:
+        Manifest.load(config.firmware_path)
+    except Espflasher as e:
+        out.emit('error', message=str(e))
+        return EXIT_USAGE
+    excel = None if args.no_record else open_records(args.records)
+    # known units and duplicate MACs are warned about before writing
+    unit_history.open(None if excel is None else excel.store.path)
+    started = {}
+    warned = {}
+
+    def on_update(result):
+        if result.status == PortResult.FLASHING and result.port not in started:
+            started[result.port] = time.perf_counter()
+            out.emit('start', port=result.port, firmware=config.firmware_path)
+        if result.mac and result.port not in warned:
+            out.emit('mac', port=result.port, mac=result.mac)
+            warned[result.port] = 0
+        # reflash / duplicate MAC warnings come after the MAC, each once
+        for warning in result.warnings[warned.get(result.port, 0):]:
+            out.emit('warning', port=result.port, mac=result.mac, message=warning)
+            warned[result.port] += 1
+        if result.status in (PortResult.PASS, PortResult.FAIL):
+            fields = dict(port=result.port, mac=result.mac, status=result.status.lower(),
+                          seconds=round(time.perf_counter() - started[result.port], 2))
+            if result.status == PortResult.PASS and excel is not None:
+                try:
+                    fields['sl_no'] = excel.save_data(result.mac, os.path.basename(config.firmware_path),
+                                                      result.verify, result.verify_ms)
+                except Exception as e:
+                    fields['record_error'] = str(e)
+            if result.verify_ms is not None:
+                fields.update(verify=result.verify, verify_ms=result.verify_ms)
+            if result.error:
+                fields['error'] = result.error
+                sys.stderr.write("--- {} ---\n{}\n".format(result.port, "".join(result.log)))
+            out.emit('result', **fields)
+
+    flash_func = backend_flash_func(config)
+    if excel is not None:
+        from to_excel import record_verify_failures
+        flash_func = record_verify_failures(flash_func)
+    gang = GangFlasher(config, args.port, max_workers=args.workers or config.gang_workers, on_update=on_update,
+                       flash_func=flash_func)
+    gang.run()
+    passed = sum(1 for result in gang.results if result.status == PortResult.PASS)
+    out.emit('summary', passed=passed, failed=len(gang.results) - passed)
+    for phase, count, mean, p50, p90, p99, slowest in station_timings.stats():
+        out.emit('timing', phase=phase, count=count, mean=round(mean, 3), p50=round(p50, 3), p90=round(p90, 3),
+                 p99=round(p99, 3), max=round(slowest, 3))
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(station_timings.to_prometheus())
+    return EXIT_OK if passed == len(gang.results) else EXIT_FAILED
+
+
+def cmd_read_mac(args, out):
+    def read(port):
+        session = FlashSession(port, before=args.before)
+        try:
+            session.connect()
+            out.emit('mac', port=port, chip=session.esp.CHIP_NAME, mac=session.read_mac())
+            return True
+        except Exception as e:
+            out.emit('result', port=port, status='fail', error=str(e))
+            return False
+        finally:
+            session.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, len(args.port))) as executor:
+        ok = list(executor.map(read, args.port))
+    return EXIT_OK if all(ok) else EXIT_FAILED
+
+
+def cmd_harvest(args, out):
+    # ROM-only identification of many boards, each stored as it finishes
+    from harvest import Harvester
+    store = None
+    if not args.no_record:
+        store = open_records(args.records).store
+
+    def on_result(board):
+        if board.error:
+            out.emit('result', port=board.port, status='fail', error=board.error)
+        else:
+            out.emit('board', seconds=round(board.seconds, 2), **board.fields())
+
+    started = time.perf_counter()
+    boards = Harvester(store, max_workers=args.workers, before=args.before, on_result=on_result).run(args.port)
+    passed = sum(1 for board in boards if not board.error)
+    out.emit('summary', passed=passed, failed=len(boards) - passed,
+             seconds=round(time.perf_counter() - started, 2))
+    return EXIT_OK if passed == len(boards) else EXIT_FAILED
+
+
+def cmd_history(args, out):
+    # lookups in the record store, or all of it exported in chunks
+    from record_store import HEADINGS
+    excel = open_records(args.records)
+    if args.export:
+        out.emit('export', path=args.export, records=excel.export(args.export))
+        return EXIT_OK
+    records = excel.store.find(mac=args.mac and args.mac.lower(), day=args.date, file_name=args.file, limit=args.limit)
+    keys = [heading.lower().replace('-', '_').replace(' ', '_') for heading in HEADINGS]
+    for record in records:
+        out.emit('record', **dict(zip(keys, record)))
+    out.emit('summary', records=len(records))
+    return EXIT_OK if records else EXIT_FAILED
+
+
+def cmd_ports(args, out):
+    watcher = PortWatcher()
+    for device in watcher.index.devices():
+        port = watcher.index.get(device)
+        out.emit('port', port=port.device, description=port.description, identity=port.identity,
+                 vid=port.vid, pid=port.pid, serial_number=port.serial_number, location=port.location)
+    return EXIT_OK
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='espflasher-cli', description='Headless ESP flasher')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    flash = sub.add_parser('flash', help='flash a .bin or .json manifest to one or more ports')
+    flash.add_argument('firmware')
+    flash.add_argument('--port', '-p', action='append', required=True, help='repeat for several ports')
+    flash.add_argument('--baud', '-b', help="baud rate or 'Auto' (default: GUI setting)")
+    flash.add_argument('--mode', choices=['qio', 'dio', 'dout'])
+    flash.add_argument('--erase', action='store_true', help='erase the whole flash first')
+    flash.add_argument('--diff', action='store_true', help='only write chunks that differ')
+    flash.add_argument('--verify', choices=['hash', 'paranoid'],
+                       help='stub MD5 only, or also read sampled sectors back')
+    flash.add_argument('--no-resume', action='store_true',
+                       help='write from the start even if an earlier attempt on the board was interrupted')
+    flash.add_argument('--workers', type=int, help='ports flashed at the same time')
+    flash.add_argument('--processes', action='store_true', help='flash every port in its own worker process')
+    flash.add_argument('--before', choices=['default_reset', 'no_reset'], help='reset into the bootloader first')
+    flash.add_argument('--after', choices=['hard_reset', 'no_reset'], help='reset to run the firmware afterwards')
+    flash.add_argument('--records', help='record store (.db) to append to instead of the GUI\'s')
+    flash.add_argument('--no-record', action='store_true', help='do not store a record per board')
+    flash.add_argument('--metrics', help='write per-phase timing in Prometheus text format to this file')
+    flash.set_defaults(func=cmd_flash)
+
+    read_mac = sub.add_parser('read-mac', help='read the MAC of one or more ports')
+    read_mac.add_argument('--port', '-p', action='append', required=True)
+    read_mac.add_argument('--before', choices=['default_reset', 'no_reset'], default='default_reset')
+    read_mac.set_defaults(func=cmd_read_mac, baud=None)
+
+    harvest = sub.add_parser('harvest', help='record MAC, revision, flash size and crystal of many boards')
+    harvest.add_argument('--port', '-p', action='append', required=True, help='repeat for several ports')
+    harvest.add_argument('--before', choices=['default_reset', 'no_reset'], default='default_reset')
+    harvest.add_argument('--workers', type=int, default=32, help='ports identified at the same time')
+    harvest.add_argument('--records', help='record store (.db) to append to instead of the GUI\'s')
+    harvest.add_argument('--no-record', action='store_true', help='only print, do not store the boards')
+    harvest.set_defaults(func=cmd_harvest, baud=None)
+
+    history = sub.add_parser('history', help='look up flashed boards by MAC, date or file, or export them')
+    history.add_argument('--mac')
+    history.add_argument('--date', help='YYYY-MM-DD')
+    history.add_argument('--file', help='firmware file name, as recorded')
+    history.add_argument('--limit', type=int, help='newest records only')
+    history.add_argument('--export', help='write every record to this .xlsx or .csv file instead')
+    history.add_argument('--records', help='record store (.db) to read instead of the GUI\'s')
+    history.set_defaults(func=cmd_history, baud=None)
+
+    ports = sub.add_parser('ports', help='list serial ports')
+    ports.set_defaults(func=cmd_ports, baud=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # anything printed outside the JSON stream goes to stderr
+    stdout = set_default_output(sys.stderr)
+    out = JsonLines(stdout)
+    baud_memory.open(get_baud_file_path())
+    checkpoints.open(get_checkpoint_file_path())
+    try:
+        return args.func(args, out)
+    except KeyboardInterrupt:
+        out.emit('error', message='interrupted')
+        return EXIT_FAILED
+    finally:
+        set_default_output(stdout)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,40 @@
 import json
-import wx
 import os
+import sys
+
+
+def get_config_dir():
+    # same directory as wx.StandardPaths.GetUserConfigDir(), so the headless
+    # entry point finds the GUI's settings without importing wx
+    if sys.platform == 'win32':
+        return os.environ.get('APPDATA') or os.path.expanduser('~')
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Preferences')
+    return os.path.expanduser('~')
 
 
 def get_config_file_path():
-    return wx.StandardPaths.Get().GetUserConfigDir() + "/esp-flasher-gui.json"
+    return get_config_dir() + "/esp-flasher-gui.json"
 
 
 def get_xl_config_file_path():
-    return wx.StandardPaths.Get().GetUserConfigDir() + "/esp-flasher-gui-excel.json"
+    return get_config_dir() + "/esp-flasher-gui-excel.json"
+
+
+def get_log_file_path():
+    return get_config_dir() + "/esp-flasher-gui.log"
+
+
+def get_baud_file_path():
+    return get_config_dir() + "/esp-flasher-gui-baud.json"
+
+
+def get_checkpoint_file_path():
+    return get_config_dir() + "/esp-flasher-gui-checkpoints.json"
+
+
+def get_records_file_path():
+    return get_config_dir() + "/esp-flasher-gui-records.db"
 
 
 class FlashConfig:
@@ -18,6 +44,16 @@ class FlashConfig:
         self.firmware_path = None
         self.mode = 'dio'
         self.erase_flash = 'No'
+        self.gang_workers = 4
+        # 'Processes' flashes every gang port in its own worker process
+        self.gang_backend = 'Threads'
+        self.log_to_file = 'No'
+        self.diff_flash = 'No'
+        self.verify = 'Hash'
+        self.resume = 'Yes'
+        # esptool --before/--after, no GUI setting; 'no_reset' for fixtures without DTR/RTS
+        self.before = 'default_reset'
+        self.after = 'hard_reset'
 
     @classmethod
     def load(cls):
@@ -31,6 +67,14 @@ class FlashConfig:
             conf.baud = data['baud']
             conf.mode = data['mode']
             conf.erase_flash = data['erase']
+            conf.gang_workers = data.get('gang_workers', conf.gang_workers)
+            conf.gang_backend = data.get('gang_backend', conf.gang_backend)
+            conf.log_to_file = data.get('log_to_file', conf.log_to_file)
+            conf.diff_flash = data.get('diff_flash', conf.diff_flash)
+            conf.verify = data.get('verify', conf.verify)
+            conf.resume = data.get('resume', conf.resume)
+            conf.before = data.get('before', conf.before)
+            conf.after = data.get('after', conf.after)
         return conf
 
     def save(self):
@@ -40,13 +84,23 @@ class FlashConfig:
             'baud': self.baud,
             'port': self.port,
             'mode': self.mode,
-            'erase': self.erase_flash
+            'erase': self.erase_flash,
+            'gang_workers': self.gang_workers,
+            'gang_backend': self.gang_backend,
+            'log_to_file': self.log_to_file,
+            'diff_flash': self.diff_flash,
+            'verify': self.verify,
+            'resume': self.resume,
+            'before': self.before,
+            'after': self.after
         }
         with open(file_path, 'w') as f:
             json.dump(date, f)
 
 
 class ExcelConfig:
+    # row counter of the old workbook-only storage, Sl-No now comes from the
+    # record store; only read once to continue the numbering
     def __init__(self):
         self.row_id = 2  # first line will be title
 
@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+
+class ConsoleLog:
+    # bounded model of the console text: writers (any thread) only touch this
+    # ring buffer, the GUI pulls a snapshot at most ~30 times a second
+    def __init__(self, max_lines=2000, spill_path=None, spill_bytes=1024 * 1024, spill_count=5):
+        self._lines = deque(maxlen=max_lines)
+        self._partial = ''
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._spill = None
+        if spill_path:
+            self.spill_to(spill_path, spill_bytes, spill_count)
+
+    def spill_to(self, path, max_bytes=1024 * 1024, count=5):
+        # complete lines also go to a rotating file, progress overwrites don't
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self._spill = logging.getLogger('esp-flasher-console')
+        self._spill.propagate = False
+        self._spill.setLevel(logging.INFO)
+        for old in list(self._spill.handlers):
+            self._spill.removeHandler(old)
+            old.close()
+        self._spill.addHandler(handler)
+
+    def write(self, string):
+        if not string:
+            return
+        with self._lock:
+            if string.startswith("\r"):
+                # rewrite the last line in place
+                self._partial = ''
+                string = string[1:]
+            parts = string.split("\n")
+            self._partial += parts[0]
+            for part in parts[1:]:
+                self._lines.append(self._partial)
+                if self._spill is not None:
+                    self._spill.info(self._partial)
+                self._partial = part
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._lines.clear()
+            self._partial = ''
+            self._dirty = True
+
+    def take(self):
+        # text to show, or None when nothing changed since the last call
+        with self._lock:
+            if not self._dirty:
+                return None
+            self._dirty = False
+            lines = list(self._lines)
+            partial = self._partial
+        lines.append(partial)
+        return "\n".join(lines)
+
+
+def benchmark(count=1000000, flush_every=1000):
+    # feeds esptool-like output and reports the time spent building the
+    # GUI text (what the timer does on the UI thread) and peak memory
+    import tracemalloc
+    log = ConsoleLog()
+    tracemalloc.start()
+    ui_time = 0.0
+    start = time.perf_counter()
+    for i in range(count):
+        if i % 4:
+            log.write("\rWriting at 0x%08x... (%d %%)" % (i * 0x400, i % 100))
+        else:
+            log.write("Wrote %d bytes at 0x%08x in 0.1 seconds...\n" % (i, i * 0x400))
+        if i % flush_every == 0:
+            t = time.perf_counter()
+            log.take()
+            ui_time += time.perf_counter() - t
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{} lines in {:.2f} s, UI thread {:.3f} s ({} flushes), peak memory {:.1f} MB".format(
+        count, total, ui_time, count // flush_every, peak / 1e6))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,2 +1,14 @@
+import multiprocessing
+import sys
+
+# a frozen build started as a flash worker process (process_flasher) runs the worker and exits here
+multiprocessing.freeze_support()
+
+# with arguments it's the headless command line (cli.py), without the GUI;
+# --startup-budget is the GUI's own start-up benchmark
+if len(sys.argv) > 1 and sys.argv[1] != '--startup-budget':
+    import cli
+    sys.exit(cli.main())
+
 import main
-main.main()
+sys.exit(main.main())
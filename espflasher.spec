@@ -8,7 +8,7 @@ a = Analysis(['espflasher.py'],
              pathex=['E:\\Work_Space\\Python\\esp-flasher-gui'],
              binaries=[],
              datas=[],
-             hiddenimports=[],
+             hiddenimports=['esptool', 'pylightxl'],
              hookspath=[],
              hooksconfig={},
              runtime_hooks=[],
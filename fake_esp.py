@@ -0,0 +1,393 @@
+import hashlib
+import os
+import pty
+import random
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+import zlib
+
+# POSIX only (pty/termios). Covers what FlashSession and esptool 3.1 use:
+# sync, read/write_reg (chip magic, eFuse MAC, SPI flash id, UART divider),
+# stub upload, change_baudrate, flash_begin/data/end and their deflate
+# versions, SPI flash MD5, erase and read_flash. Connect with
+# before='no_reset', a pty has no DTR/RTS to reset the board with.
+
+# termios speed constants -> baud
+BAUD_RATES = {getattr(termios, 'B%d' % b): b for b in [9600, 19200, 38400, 57600, 115200, 230400, 460800,
+                                                       921600, 1500000, 2000000] if hasattr(termios, 'B%d' % b)}
+
+DETECTED_SIZE_IDS = {0x100000: 0x14, 0x200000: 0x15, 0x400000: 0x16, 0x800000: 0x17, 0x1000000: 0x18}
+
+# command opcodes, see esptool.ESPLoader
+FLASH_BEGIN = 0x02
+FLASH_DATA = 0x03
+FLASH_END = 0x04
+MEM_BEGIN = 0x05
+MEM_END = 0x06
+MEM_DATA = 0x07
+SYNC = 0x08
+WRITE_REG = 0x09
+READ_REG = 0x0a
+SPI_SET_PARAMS = 0x0b
+SPI_ATTACH = 0x0d
+CHANGE_BAUDRATE = 0x0f
+FLASH_DEFL_BEGIN = 0x10
+FLASH_DEFL_DATA = 0x11
+FLASH_DEFL_END = 0x12
+SPI_FLASH_MD5 = 0x13
+ERASE_FLASH = 0xd0
+ERASE_REGION = 0xd1
+READ_FLASH = 0xd2
+
+# error codes in the status bytes
+ERR_INVALID_MESSAGE = 0x05
+ERR_BAD_CHECKSUM = 0x07
+ERR_FLASH_WRITE = 0x08
+
+SECTOR_SIZE = 0x1000
+
+
+def slip_encode(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+def checksum(data, state=0xef):
+    for b in data:
+        state ^= b
+    return state
+
+
+class Chip:
+    name = None
+    magic = None
+    rom_status_length = 2
+    spi_base = None
+    spi_w0 = None
+    uart_clkdiv_reg = None
+    xtal_divider = 1
+    xtal_mhz = 40
+
+    def registers(self, mac):
+        return {}
+
+
+class Esp32Chip(Chip):
+    name = 'ESP32'
+    magic = 0x00f01d83
+    rom_status_length = 4
+    spi_base = 0x3ff42000
+    spi_w0 = 0x80
+    uart_clkdiv_reg = 0x3ff40014
+    efuse_base = 0x3ff5a000
+
+    def registers(self, mac):
+        return {
+            self.efuse_base + 4: (mac[2] << 24) | (mac[3] << 16) | (mac[4] << 8) | mac[5],
+            self.efuse_base + 8: (mac[0] << 8) | mac[1],
+            # revision 1 ESP32-D0WDQ6
+            self.efuse_base + 12: 1 << 15,
+        }
+
+
+class Esp8266Chip(Chip):
+    name = 'ESP8266'
+    magic = 0xfff0c101
+    spi_base = 0x60000200
+    spi_w0 = 0x40
+    uart_clkdiv_reg = 0x60000014
+    xtal_divider = 2
+    xtal_mhz = 26
+
+    def registers(self, mac):
+        return {
+            0x3ff00050: mac[5] << 24,
+            0x3ff00054: (mac[3] << 8) | mac[4],
+            0x3ff0005c: (mac[0] << 16) | (mac[1] << 8) | mac[2],
+        }
+
+
+CHIPS = {'ESP32': Esp32Chip, 'ESP8266': Esp8266Chip}
+
+
+class FakeEsp:
+    # a simulated ESP ROM bootloader (and flasher stub) on a pseudo-terminal,
+    # open self.port with esptool/pyserial like a real board (without reset lines);
+    # latency is added per command, realtime paces the bytes at the line baud,
+    # a baud above max_baud is garbage to the chip, error_rate fails data
+    # blocks with a checksum error and disconnect_after goes silent
+    def __init__(self, chip='ESP32', mac=None, flash_size=0x400000, latency=0.0, max_baud=921600,
+                 realtime=False, error_rate=0.0, disconnect_after=None, seed=None):
+        self.chip = CHIPS[chip]()
+        self.mac = mac or bytes([0x24, 0x0a, 0xc4] + [random.randrange(256) for _ in range(3)])
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.latency = latency
+        self.max_baud = max_baud
+        self.realtime = realtime
+        self.error_rate = error_rate
+        self.disconnect_after = disconnect_after
+        self._random = random.Random(seed)
+        self.registers = self.chip.registers(self.mac)
+        self.stub = False
+        self.stats = {'commands': 0, 'bytes_in': 0, 'bytes_out': 0, 'errors': 0, 'flash_written': 0}
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        self.port = os.ttyname(self._slave)
+        self._running = False
+        self._thread = None
+        self._write = None
+        self._blocks_written = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(1)
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def reset(self):
+        # power cycle: back to the ROM bootloader, flash is kept
+        self.stub = False
+        self._write = None
+
+    def line_baud(self):
+        return BAUD_RATES.get(termios.tcgetattr(self._master)[5], 115200)
+
+    def _serve(self):
+        packet = None
+        escape = False
+        while self._running:
+            try:
+                ready, _, _ = select.select([self._master], [], [], 0.05)
+                if not ready:
+                    continue
+                data = os.read(self._master, 65536)
+            except OSError:
+                break
+            self.stats['bytes_in'] += len(data)
+            self._throttle(len(data))
+            for b in data:
+                if packet is None:
+                    if b == 0xc0:
+                        packet = bytearray()
+                elif escape:
+                    escape = False
+                    packet.append({0xdc: 0xc0, 0xdd: 0xdb}.get(b, b))
+                elif b == 0xdb:
+                    escape = True
+                elif b == 0xc0:
+                    if packet:
+                        self._handle(bytes(packet))
+                        packet = None
+                    else:
+                        packet = bytearray()
+                else:
+                    packet.append(b)
+
+    def _throttle(self, size):
+        if self.realtime:
+            time.sleep(size * 10.0 / self.line_baud())
+
+    def _send(self, packet):
+        data = slip_encode(packet)
+        self._throttle(len(data))
+        self.stats['bytes_out'] += len(data)
+        os.write(self._master, data)
+
+    def _reply(self, op, data=b'', value=0, error=0):
+        status_length = 2 if self.stub else self.chip.rom_status_length
+        status = bytes([1 if error else 0, error]) + b'\x00' * (status_length - 2)
+        data += status
+        self._send(struct.pack('<BBHI', 1, op, len(data), value) + data)
+
+    def _handle(self, packet):
+        if len(packet) < 8:
+            return  # read_flash acknowledgements
+        direction, op, size, chk = struct.unpack('<BBHI', packet[:8])
+        if direction != 0:
+            return
+        data = packet[8:8 + size]
+        self.stats['commands'] += 1
+
+        if self.line_baud() > self.max_baud:
+            # the bridge can't keep up, the chip sees garbage and never answers
+            return
+        if self.disconnect_after is not None and self.stats['bytes_in'] > self.disconnect_after:
+            # unplugged, stays silent until reset
+            return
+        if self.latency:
+            time.sleep(self.latency)
+
+        handler = getattr(self, '_op_%02x' % op, None)
+        if handler is None:
+            self._reply(op, error=ERR_INVALID_MESSAGE)
+            return
+        handler(op, data, chk)
+
+    def _inject_error(self):
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return True
+        return False
+
+    # sync
+    def _op_08(self, op, data, chk):
+        value = 0 if self.stub else 0x20120707
+        for _ in range(8):
+            self._reply(op, value=value)
+
+    # write_reg
+    def _op_09(self, op, data, chk):
+        addr, value, mask, _ = struct.unpack('<IIII', data[:16])
+        old = self.registers.get(addr, 0)
+        self.registers[addr] = (old & ~mask) | (value & mask)
+        if addr == self.chip.spi_base and value & (1 << 18):
+            # SPI user command, answer with the JEDEC id in W0
+            size_id = DETECTED_SIZE_IDS.get(len(self.flash), 0x16)
+            self.registers[self.chip.spi_base + self.chip.spi_w0] = (size_id << 16) | 0x40ef
+            self.registers[addr] = 0
+        self._reply(op)
+
+    # read_reg
+    def _op_0a(self, op, data, chk):
+        addr, = struct.unpack('<I', data[:4])
+        if addr == 0x40001000:
+            value = self.chip.magic
+        elif addr == self.chip.uart_clkdiv_reg:
+            value = int(self.chip.xtal_mhz * 1e6 * self.chip.xtal_divider / self.line_baud())
+        else:
+            value = self.registers.get(addr, 0)
+        self._reply(op, value=value)
+
+    # mem_begin, mem_data
+    def _op_05(self, op, data, chk):
+        self._reply(op)
+
+    def _op_07(self, op, data, chk):
+        self._reply(op, error=ERR_BAD_CHECKSUM if checksum(data[16:]) != chk else 0)
+
+    # mem_end, starts the uploaded stub
+    def _op_06(self, op, data, chk):
+        self._reply(op)
+        self.stub = True
+        self._send(b'OHAI')
+
+    # spi_set_params, spi_attach
+    def _op_0b(self, op, data, chk):
+        self._reply(op)
+
+    def _op_0d(self, op, data, chk):
+        self._reply(op)
+
+    # change_baudrate, the reply still goes out at the old rate
+    def _op_0f(self, op, data, chk):
+        self._reply(op)
+
+    def _begin(self, size, offset, compressed):
+        # ROM erases up front, stub erases as it writes; either way the range ends up blank
+        end = offset + size
+        if end > len(self.flash):
+            return ERR_FLASH_WRITE
+        erase_end = (end + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+        self.flash[offset:erase_end] = b'\xff' * (erase_end - offset)
+        self._write = {'offset': offset, 'size': size, 'written': 0, 'seq': 0,
+                       'decompress': zlib.decompressobj() if compressed else None}
+        return 0
+
+    # flash_begin, flash_defl_begin
+    def _op_02(self, op, data, chk):
+        size, blocks, block_size, offset = struct.unpack('<IIII', data[:16])
+        self._reply(op, error=self._begin(size, offset, False) if size else 0)
+
+    def _op_10(self, op, data, chk):
+        size, blocks, block_size, offset = struct.unpack('<IIII', data[:16])
+        self._reply(op, error=self._begin(size, offset, True))
+
+    def _data(self, op, data, chk):
+        length, seq, _, _ = struct.unpack('<IIII', data[:16])
+        payload = data[16:16 + length]
+        write = self._write
+        if write is None or seq != write['seq']:
+            self._reply(op, error=ERR_INVALID_MESSAGE)
+            return
+        if checksum(payload) != chk or self._inject_error():
+            self._reply(op, error=ERR_BAD_CHECKSUM)
+            return
+        if write['decompress'] is not None:
+            payload = write['decompress'].decompress(payload)
+        else:
+            payload = payload[:max(0, write['size'] - write['written'])]
+        start = write['offset'] + write['written']
+        self.flash[start:start + len(payload)] = payload
+        write['written'] += len(payload)
+        write['seq'] += 1
+        self.stats['flash_written'] += len(payload)
+        self._reply(op)
+
+    # flash_data, flash_defl_data
+    def _op_03(self, op, data, chk):
+        self._data(op, data, chk)
+
+    def _op_11(self, op, data, chk):
+        self._data(op, data, chk)
+
+    # flash_end, flash_defl_end
+    def _op_04(self, op, data, chk):
+        self._write = None
+        self._reply(op)
+
+    def _op_12(self, op, data, chk):
+        self._write = None
+        self._reply(op)
+
+    # spi_flash_md5, ROM answers in hex, the stub raw
+    def _op_13(self, op, data, chk):
+        addr, size, _, _ = struct.unpack('<IIII', data[:16])
+        digest = hashlib.md5(bytes(self.flash[addr:addr + size]))
+        self._reply(op, digest.digest() if self.stub else digest.hexdigest().encode())
+
+    # erase_flash, erase_region (stub only)
+    def _op_d0(self, op, data, chk):
+        if not self.stub:
+            self._reply(op, error=ERR_INVALID_MESSAGE)
+            return
+        self.flash[:] = b'\xff' * len(self.flash)
+        self._reply(op)
+
+    def _op_d1(self, op, data, chk):
+        offset, size = struct.unpack('<II', data[:8])
+        if not self.stub or offset % SECTOR_SIZE or size % SECTOR_SIZE:
+            self._reply(op, error=ERR_INVALID_MESSAGE)
+            return
+        self.flash[offset:offset + size] = b'\xff' * size
+        self._reply(op)
+
+    # read_flash (stub only): data frames, then the MD5 of everything sent
+    def _op_d2(self, op, data, chk):
+        offset, length, block_size, _ = struct.unpack('<IIII', data[:16])
+        if not self.stub:
+            self._reply(op, error=ERR_INVALID_MESSAGE)
+            return
+        self._reply(op)
+        content = bytes(self.flash[offset:offset + length])
+        for pos in range(0, length, block_size):
+            self._send(content[pos:pos + block_size])
+        self._send(hashlib.md5(content).digest())
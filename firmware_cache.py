@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+import zlib
+from argparse import Namespace
+from lazy import LazyModule
+
+esptool = LazyModule('esptool')
+
+# bootloader offsets of all chips (0x0: ESP8266, C3, S3; 0x1000: ESP32, S2);
+# an image anywhere else is written unchanged, whatever the chip
+BOOTLOADER_OFFSETS = (0x0, 0x1000)
+
+
+def image_key(esp, address, mode, flash_size):
+    # esptool patches flash mode and size into the image at the chip's
+    # bootloader offset only; esp is a chip object or class, None if unknown
+    if esp is not None and address == esp.BOOTLOADER_FLASH_OFFSET:
+        return address, esp.CHIP_NAME, mode, flash_size
+    return (address,)
+
+
+def prepare_image(esp, address, image, mode, flash_size):
+    # same padding and bootloader header patching esptool write_flash does
+    image = esptool.pad_to(image, 4)
+    if esp is None:
+        return image
+    args = Namespace(flash_mode=mode, flash_freq='keep', flash_size=flash_size or 'keep')
+    return esptool._update_image_flash_params(esp, address, args, image)
+
+
+class PreparedImage:
+    # the image as it is written for one offset/chip/flash setting, with its
+    # digest and deflate stream computed once and shared read-only
+    def __init__(self, image):
+        self.image = image
+        self.size = len(image)
+        self.md5 = hashlib.md5(image).hexdigest()
+        self.compressed = zlib.compress(image, 9)
+        self._blocks = {}
+        self._chunks = {}
+        self._trimmed = None
+        self._lock = threading.Lock()
+
+    def trimmed(self):
+        # same image without the trailing erased (0xFF) bytes, which need no transfer
+        with self._lock:
+            if self._trimmed is None:
+                end = len(self.image.rstrip(b'\xff'))
+                end += -end % 4
+                self._trimmed = self if end >= self.size else PreparedImage(self.image[:end])
+            return self._trimmed
+
+    def chunks(self, chunk_size):
+        # [(offset, PreparedImage)] of chunk_size pieces, for differential writes
+        with self._lock:
+            if chunk_size not in self._chunks:
+                self._chunks[chunk_size] = [(offset, PreparedImage(self.image[offset:offset + chunk_size]))
+                                            for offset in range(0, self.size, chunk_size)]
+            return self._chunks[chunk_size]
+
+    def blocks(self, block_size):
+        # [(compressed block, bytes it inflates to)] for the loader's block size
+        with self._lock:
+            if block_size not in self._blocks:
+                decompress = zlib.decompressobj()
+                blocks = []
+                for pos in range(0, len(self.compressed), block_size):
+                    block = self.compressed[pos:pos + block_size]
+                    blocks.append((block, len(decompress.decompress(block))))
+                self._blocks[block_size] = blocks
+            return self._blocks[block_size]
+
+
+class FirmwareImage:
+    def __init__(self, path, data=None):
+        self.path = path
+        stat = os.stat(path)
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        if data is not None:
+            # contents already in memory, e.g. shared by the parent of a flash process
+            self.data = data
+        else:
+            # read whole and closed right away, the file stays free to be rebuilt
+            # (a mapping would lock it on Windows and be copied by prepared() anyway)
+            with open(path, 'rb') as f:
+                self.data = f.read()
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self._prepared = {}
+        self._lock = threading.Lock()
+
+    def prepared(self, key, prepare):
+        # prepare(raw bytes) -> bytes to write; runs once per key, later callers
+        # wait for the first one instead of compressing again
+        with self._lock:
+            if key not in self._prepared:
+                self._prepared[key] = PreparedImage(prepare(bytes(self.data)))
+            return self._prepared[key]
+
+    def prepared_for(self, esp, address, mode, flash_size):
+        # the image as written at address, esp None only for addresses outside BOOTLOADER_OFFSETS
+        return self.prepared(image_key(esp, address, mode, flash_size),
+                             lambda data: prepare_image(esp, address, data, mode, flash_size))
+
+
+class FirmwareCache:
+    # content-hashed firmware images shared by all flash workers
+    def __init__(self, max_targets=4):
+        self._images = {}
+        # (chip name, flash size) -> chip class of the last boards flashed,
+        # a new firmware is prepared for them before the next board is there
+        self._targets = {}
+        self._max_targets = max_targets
+        self._lock = threading.Lock()
+
+    def remember_target(self, esp, flash_size):
+        with self._lock:
+            key = (esp.CHIP_NAME, flash_size)
+            self._targets.pop(key, None)
+            self._targets[key] = type(esp)
+            while len(self._targets) > self._max_targets:
+                del self._targets[next(iter(self._targets))]
+
+    def targets(self):
+        # [(chip class, flash size)], most recent last
+        with self._lock:
+            return [(chip, flash_size) for (_, flash_size), chip in self._targets.items()]
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            image = self._images.get(path)
+            if image is not None and (image.mtime, image.size) == (stat.st_mtime_ns, stat.st_size):
+                return image
+            fresh = FirmwareImage(path)
+            if image is not None and image.md5 == fresh.md5:
+                # touched but same content, the compressed streams still apply
+                fresh._prepared = image._prepared
+            self._images[path] = fresh
+            return fresh
+
+    def share(self, path, data):
+        # use data (the file's contents) instead of reading the file
+        path = os.path.abspath(path)
+        with self._lock:
+            self._images[path] = FirmwareImage(path, data)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+
+
+firmware_cache = FirmwareCache()
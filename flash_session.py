@@ -0,0 +1,447 @@
+import hashlib
+import random
+import serial
+import time
+from baud_tuner import BAUD_STEPS, baud_memory, is_auto, lower_step, port_identity
+from checkpoint import RESUME_CHUNK_SIZE, checkpoints, firmware_key
+from flasher import Espflasher, VerifyError
+from firmware_cache import firmware_cache
+from manifest import Manifest
+from prestage import prestage
+from timing import station_timings
+from unit_history import unit_history
+from lazy import LazyModule
+
+esptool = LazyModule('esptool')
+
+# phases of one flashing session, in the order they run
+PHASES = ['connect', 'read_mac', 'stub', 'change_baud', 'flash_size', 'erase', 'prepare', 'resume', 'diff', 'write', 'md5',
+          'readback', 'reset']
+
+# differential writes compare and rewrite the image in pieces of this size
+DIFF_CHUNK_SIZE = 0x10000
+
+# 'hash' compares the stub's MD5 of every segment with the image digest,
+# 'paranoid' also reads sampled sectors back and compares them byte for byte
+VERIFY_MODES = ['hash', 'paranoid']
+PARANOID_SAMPLES = 8
+
+# auto baud reads this much flash back at every step to measure the link
+PROBE_SIZE = 0x1000
+
+
+class FlashSession:
+    # one connection to one device for the whole cycle: connect and sync once,
+    # read the MAC, upload the stub once, switch baud, write and hard reset
+    def __init__(self, port, baud=115200, mode='dio', erase_all=False, diff=False, verify='hash', progress=None,
+                 before='default_reset', after='hard_reset', resume=True, on_warning=None):
+        self.port = port
+        # esptool's --before/--after, 'no_reset' for boards without reset lines (and fake_esp)
+        self.before = before
+        self.after = after
+        # 'Auto' ramps up from the ROM baud after the stub is running
+        self.auto_baud = is_auto(baud)
+        self.baud = BAUD_STEPS[0] if self.auto_baud else int(baud)
+        self.tuned = False
+        self.mode = mode
+        self.erase_all = erase_all
+        # only rewrite the chunks whose MD5 on the chip differs
+        self.diff = diff
+        # record confirmed chunks per MAC and continue after them next time
+        self.resume = resume
+        self._checkpoint_key = None
+        self.verify = verify.lower()
+        self.verify_time = None
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self.esp = None
+        self.mac = None
+        self.flash_size = None
+        self.timings = {}
+        # (address, md5) already confirmed on the chip by the diff, not verified again
+        self._matched = set()
+        # optional ProgressChannel for the GUI / gang list
+        self.progress = progress
+        # reflash / duplicate MAC warnings of this board, on_warning(text) is
+        # called for each as soon as the MAC is read
+        self.warnings = []
+        self.on_warning = on_warning
+
+    @classmethod
+    def from_config(cls, config, port=None, progress=None, on_warning=None):
+        return cls(port or config.port, baud=config.baud, mode=config.mode,
+                   erase_all=config.erase_flash == "Yes", diff=config.diff_flash == "Yes", verify=config.verify,
+                   progress=progress, before=config.before, after=config.after,
+                   resume=config.resume == "Yes", on_warning=on_warning)
+
+    def _report(self, phase, done, total, started):
+        if self.progress is not None:
+            self.progress.post(self.port, phase, done, total, started)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _timed(self, phase, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except esptool.FatalError as err:
+            raise Espflasher("{} failed on {}: {}".format(phase, self.port, err))
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + time.perf_counter() - start
+
+    def connect(self):
+        # ESPLoader.detect_chip() already resets and syncs the ROM bootloader,
+        # the chip object it returns is ready to use; it takes the port
+        # prestage opened ahead of time if there is one
+        initial_baud = min(esptool.ESPLoader.ESP_ROM_BAUD, self.baud)
+        self._report('connect', 0, 1, time.perf_counter())
+        port = prestage.take_port(self.port) or self.port
+        try:
+            self.esp = self._timed('connect', esptool.ESPLoader.detect_chip, port, initial_baud, self.before)
+        except Exception:
+            if port is not self.port:
+                port.close()
+            raise
+        print("Chip is %s" % self.esp.get_chip_description())
+        return self.esp
+
+    def read_mac(self):
+        mac = self._timed('read_mac', self.esp.read_mac)
+        self.mac = ':'.join('{:02x}'.format(x) for x in mac)
+        print('MAC: %s' % self.mac)
+        # reflash of a known unit or a duplicate MAC, warned before anything is written
+        for warning in unit_history.check(self.mac, self.port):
+            self.warnings.append(warning)
+            if self.on_warning is not None:
+                self.on_warning(warning)
+        return self.mac
+
+    def run_stub(self):
+        if not self.esp.IS_STUB:
+            self.esp = self._timed('stub', self.esp.run_stub)
+
+    def change_baud(self):
+        if self.auto_baud and not self.tuned:
+            self.tune_baud()
+        elif self.baud > self.esp._port.baudrate:
+            self._timed('change_baud', self.esp.change_baud, self.baud)
+
+    def tune_baud(self):
+        # ramp up step by step while the probe read comes back intact and
+        # faster; a rate remembered for this USB bridge is tried first and
+        # walked down a step at a time if it no longer works
+        identity = port_identity(self.port)
+        good, good_rate = self.esp._port.baudrate, 0
+        remembered = baud_memory.best(identity)
+        if remembered:
+            steps = [step for step in BAUD_STEPS if good < step <= remembered][::-1]
+        else:
+            steps = [step for step in BAUD_STEPS if step > good]
+        for baud in steps:
+            try:
+                self._timed('change_baud', self.esp.change_baud, baud)
+                rate = self._timed('change_baud', self._probe)
+            except (Espflasher, serial.SerialException) as err:
+                print('Baud {} failed ({})'.format(baud, err))
+                baud_memory.record_failure(identity, baud)
+                self.reconnect(good)
+                if remembered:
+                    continue
+                break
+            if rate < good_rate:
+                # the bridge or hub is the bottleneck, back to the faster rate
+                self._timed('change_baud', self.esp.change_baud, good)
+                break
+            good, good_rate = baud, rate
+            if remembered:
+                break
+        self.baud = good
+        self.tuned = True
+        print('Auto baud: {} ({:.1f} kB/s read back)'.format(good, good_rate / 1000))
+
+    def _probe(self):
+        start = time.perf_counter()
+        self.esp.read_flash(0, PROBE_SIZE)
+        return PROBE_SIZE / (time.perf_counter() - start)
+
+    def reconnect(self, baud):
+        # a chip left at a rate the link can't carry only answers after a reset
+        self._close_port()
+        self.connect()
+        self.run_stub()
+        self.baud = baud
+        if baud > self.esp._port.baudrate:
+            self._timed('change_baud', self.esp.change_baud, baud)
+        if self.flash_size is not None:
+            self.esp.flash_set_parameters(esptool.flash_size_bytes(self.flash_size))
+
+    def fall_back(self, err):
+        # auto baud only: one step down and reconnect instead of failing the board
+        lower = lower_step(self.baud) if self.auto_baud else None
+        if lower is None:
+            return False
+        print('Flashing at {} failed ({}), retrying at {}'.format(self.baud, err, lower))
+        baud_memory.record_failure(port_identity(self.port), self.baud)
+        self.reconnect(lower)
+        return True
+
+    def detect_flash_size(self):
+        def detect():
+            size_id = self.esp.flash_id() >> 16
+            size = esptool.DETECTED_FLASH_SIZES.get(size_id)
+            if size is None:
+                print('Warning: Could not auto-detect Flash size (SizeID=0x%x), defaulting to 4MB' % size_id)
+                size = '4MB'
+            else:
+                print('Auto-detected Flash size:', size)
+            self.esp.flash_set_parameters(esptool.flash_size_bytes(size))
+            return size
+        self.flash_size = self._timed('flash_size', detect)
+        return self.flash_size
+
+    def erase_flash(self):
+        print('Erasing flash (this may take a while)...')
+        self._report('erase', 0, 1, time.perf_counter())
+        self._timed('erase', self.esp.erase_flash)
+
+    def prepared_image(self, address, firmware):
+        # firmware is a cached FirmwareImage, the patched image, its MD5 and
+        # deflate blocks are computed by the first board (or by prestage) only
+        firmware_cache.remember_target(self.esp, self.flash_size)
+        return self._timed('prepare', firmware.prepared_for, self.esp, address, self.mode, self.flash_size)
+
+    def write_image(self, address, firmware):
+        image = self.prepared_image(address, firmware)
+        if self.diff and address % self.esp.FLASH_SECTOR_SIZE == 0:
+            self.write_diff(address, image)
+        else:
+            self.write_trimmed(address, image)
+
+    def write_trimmed(self, address, image):
+        # trailing 0xFF isn't sent, its sectors are only erased
+        trimmed = image.trimmed()
+        sector = self.esp.FLASH_SECTOR_SIZE
+        resumed = 0
+        if self._checkpoint_key and address % sector == 0 and trimmed.size > RESUME_CHUNK_SIZE:
+            resumed = self._write_resumable(address, trimmed)
+        elif trimmed.size:
+            self._timed('write', self._write_compressed, address, trimmed)
+        start = address + trimmed.size + (-(address + trimmed.size) % sector)
+        end = address + image.size + (-(address + image.size) % sector)
+        if end > start and not self.erase_all:
+            self._timed('erase', self.esp.erase_region, start, end - start)
+        self.bytes_written += trimmed.size - resumed
+        self.bytes_skipped += image.size - trimmed.size + resumed
+
+    def _write_resumable(self, address, image):
+        # chunk by chunk, each one recorded once the stub has it in flash;
+        # returns the bytes an interrupted attempt had already written
+        resumed = self._timed('resume', self._resume_offset, address, image)
+        for offset, chunk in image.chunks(RESUME_CHUNK_SIZE):
+            if offset < resumed:
+                continue
+            self._timed('write', self._write_compressed, address + offset, chunk)
+            checkpoints.confirm(self.mac, address, image.md5, offset + chunk.size)
+        return resumed
+
+    def _resume_offset(self, address, image):
+        # the checkpoint is only trusted if the region MD5 still matches
+        confirmed = checkpoints.confirmed(self.mac, address, image.md5)
+        if not confirmed:
+            return 0
+        if self.esp.flash_md5sum(address, confirmed) != hashlib.md5(image.image[:confirmed]).hexdigest():
+            print('Checkpoint at 0x%08x does not match the flash, writing from the start' % address)
+            return 0
+        print('Resuming at 0x{:08x}, {} bytes already written'.format(address + confirmed, confirmed))
+        return confirmed
+
+    def write_diff(self, address, image):
+        # compare sector-aligned chunks with the flash and write only those that differ
+        if self._timed('diff', self.esp.flash_md5sum, address, image.size) == image.md5:
+            print('Flash already matches the image, nothing to write.')
+            self._matched.add((address, image.md5))
+            self.bytes_skipped += image.size
+            return
+        chunks = image.chunks(DIFF_CHUNK_SIZE)
+        changed = [(offset, chunk) for offset, chunk in chunks
+                   if self._timed('diff', self.esp.flash_md5sum, address + offset, chunk.size) != chunk.md5]
+        skipped = image.size - sum(chunk.size for _, chunk in changed)
+        print('Diff: {} of {} chunks differ, skipping {} bytes'.format(len(changed), len(chunks), skipped))
+        for offset, chunk in changed:
+            self._timed('write', self._write_compressed, address + offset, chunk)
+        self.bytes_written += image.size - skipped
+        self.bytes_skipped += skipped
+
+    def _write_compressed(self, address, image):
+        esp = self.esp
+        blocks = image.blocks(esp.FLASH_WRITE_SIZE)
+        esp.flash_defl_begin(image.size, len(image.compressed), address)
+        timeout = esptool.DEFAULT_TIMEOUT
+        written = 0
+        start = time.perf_counter()
+        self._report('write', 0, image.size, start)
+        for seq, (block, block_uncompressed) in enumerate(blocks):
+            esptool.print_overwrite('Writing at 0x%08x... (%d %%)' % (address + written, 100 * (seq + 1) // len(blocks)))
+            written += block_uncompressed
+            block_timeout = max(esptool.DEFAULT_TIMEOUT,
+                                esptool.timeout_per_mb(esptool.ERASE_WRITE_TIMEOUT_PER_MB, block_uncompressed))
+            if not esp.IS_STUB:
+                timeout = block_timeout  # ROM writes the block before it ACKs
+            esp.flash_defl_block(block, seq, timeout=timeout)
+            if esp.IS_STUB:
+                timeout = block_timeout  # stub ACKs first and writes while receiving the next block
+            self._report('write', written, image.size, start)
+        if esp.IS_STUB:
+            # not ACKed until the last block is actually in flash
+            esp.read_reg(esptool.ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR, timeout=timeout)
+        t = time.perf_counter() - start
+        esptool.print_overwrite('Wrote %d bytes (%d compressed) at 0x%08x in %.1f seconds...'
+                                % (image.size, len(image.compressed), address, t), last_line=True)
+
+    def _check_md5(self, address, size, md5):
+        res = self.esp.flash_md5sum(address, size)
+        if res != md5:
+            print('File  md5: %s' % md5)
+            print('Flash md5: %s' % res)
+            raise esptool.FatalError("MD5 of file does not match data in flash!")
+        print('Hash of data verified.')
+
+    def hard_reset(self):
+        def reset():
+            print('\nLeaving...')
+            if self.esp.IS_STUB:
+                # leave flash mode without running the app, reset does that
+                self.esp.flash_begin(0, 0)
+                self.esp.flash_defl_finish(False)
+            if self.after == 'no_reset':
+                print('Staying in bootloader.')
+            else:
+                self.esp.hard_reset()
+        self._timed('reset', reset)
+
+    def close(self):
+        unit_history.release(self.port)
+        self._close_port()
+
+    def _close_port(self):
+        if self.esp is not None:
+            self.esp._port.close()
+            self.esp = None
+
+    def flash(self, firmware_path):
+        # firmware_path is a single .bin (written at 0x0) or a .json manifest
+        manifest = Manifest.load(firmware_path)
+        ok = False
+        try:
+            if self.esp is None:
+                self.connect()
+            if self.mac is None:
+                self.read_mac()
+            self.begin(manifest)
+            self.write_segments(manifest)
+            self.verify_segments(manifest)
+            self.hard_reset()
+            self._report('done', 1, 1, time.perf_counter())
+            ok = True
+        finally:
+            self.close()
+            station_timings.add_device(self.port, self.timings, ok)
+        print(self.timing_report())
+        return self.mac
+
+    def begin(self, manifest=None):
+        # everything between reading the MAC and the first write; with the
+        # manifest, an interrupted attempt on this board is continued
+        self.run_stub()
+        self.change_baud()
+        self.detect_flash_size()
+        checkpoint = self._open_checkpoint(manifest)
+        if self.erase_all and self.diff:
+            print('Erase Flash is ignored in differential mode')
+        elif self.erase_all and checkpoint and checkpoint['erased']:
+            print('Flash was erased by the interrupted attempt, not erasing again')
+        elif self.erase_all:
+            self.erase_flash()
+        if self._checkpoint_key:
+            checkpoints.start(self.mac, self._checkpoint_key, self.erase_all)
+
+    def _open_checkpoint(self, manifest):
+        # differential writes compare the flash anyway and need no checkpoints
+        if not self.resume or self.diff or manifest is None or self.mac is None:
+            return None
+        self._checkpoint_key = firmware_key([(address, firmware_cache.get(file))
+                                             for address, file in manifest.segments_for(self.esp.CHIP_NAME)])
+        return checkpoints.get(self.mac, self._checkpoint_key)
+
+    def write_segments(self, manifest):
+        # all segments in address order over this one connection, written
+        # again one baud step lower if the link fails in auto baud mode
+        while True:
+            try:
+                for address, file in manifest.segments_for(self.esp.CHIP_NAME):
+                    self.write_image(address, firmware_cache.get(file))
+                break
+            except (Espflasher, serial.SerialException) as err:
+                if not self.fall_back(err):
+                    raise
+        if self.auto_baud:
+            write_time = self.timings.get('write', 0.0)
+            baud_memory.record_success(port_identity(self.port), self.baud,
+                                       self.bytes_written / write_time if write_time else 0)
+
+    def verify_segments(self, manifest):
+        # against the cached digests, nothing is hashed on the host here
+        start = time.perf_counter()
+        self._report('verify', 0, 1, start)
+        try:
+            segments = [(address, self.prepared_image(address, firmware_cache.get(file)))
+                        for address, file in manifest.segments_for(self.esp.CHIP_NAME)]
+            for address, image in segments:
+                if (address, image.md5) not in self._matched:
+                    self._timed('md5', self._check_md5, address, image.size, image.md5)
+            if self.verify == 'paranoid':
+                for address, image in segments:
+                    self._timed('readback', self._check_readback, address, image)
+        except Espflasher as err:
+            self.verify_time = time.perf_counter() - start
+            # what was written is wrong, the next attempt starts over
+            checkpoints.clear(self.mac)
+            raise VerifyError(str(err), self.mac, self.verify, self.verify_ms())
+        self.verify_time = time.perf_counter() - start
+        checkpoints.clear(self.mac)
+        print('Verify ({}) passed in {:.2f} s'.format(self.verify, self.verify_time))
+
+    def verify_ms(self):
+        return None if self.verify_time is None else int(self.verify_time * 1000)
+
+    def _check_readback(self, address, image):
+        # first, last and a sample of the sectors in between, a different
+        # sample per board (seeded with the MAC)
+        sector = self.esp.FLASH_SECTOR_SIZE
+        count = (image.size + sector - 1) // sector
+        if not count:
+            return
+        picks = {0, count - 1} | set(random.Random(self.mac).sample(range(count), min(count, PARANOID_SAMPLES)))
+        for index in sorted(picks):
+            expected = image.image[index * sector:(index + 1) * sector]
+            if self.esp.read_flash(address + index * sector, len(expected)) != expected:
+                raise esptool.FatalError('Read back sector at 0x%08x differs from the image' % (address + index * sector))
+        print('Read back {} of {} sectors at 0x{:08x}'.format(len(picks), count, address))
+
+    def timing_report(self):
+        lines = ['Timing ({}, {} baud):'.format(self.port, self.baud)]
+        for phase in PHASES:
+            if phase in self.timings:
+                lines.append('  {:<12}{:>7.2f} s'.format(phase, self.timings[phase]))
+        lines.append('  {:<12}{:>7.2f} s'.format('total', sum(self.timings.values())))
+        # a separate MAC read followed by esptool.main() pays connect and sync twice
+        saved = self.timings.get('connect', 0.0) + self.timings.get('read_mac', 0.0)
+        lines.append('  {:<12}{:>7.2f} s'.format('saved', saved))
+        if self.bytes_skipped:
+            lines.append('  {:<12}{:>7} bytes not transferred'.format('skipped', self.bytes_skipped))
+        return '\n'.join(lines)
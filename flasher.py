@@ -0,0 +1,58 @@
+import serial
+import os
+from lazy import LazyModule
+from output_router import output_to
+
+esptool = LazyModule('esptool')
+
+DEVNULL = open(os.devnull, 'w')
+
+
+class Espflasher(Exception):
+    pass
+
+
+class VerifyError(Espflasher):
+    # the image was written but doesn't match, carries what goes into the failure record
+    def __init__(self, message, mac, mode, verify_ms):
+        Espflasher.__init__(self, message)
+        self.mac = mac
+        self.mode = mode
+        self.verify_ms = verify_ms
+
+
+def detect_chip(port, before='default_reset'):
+    # detection resets and syncs the bootloader, the returned chip is
+    # already connected and must not be synced a second time
+    try:
+        chip = esptool.ESPLoader.detect_chip(port, connect_mode=before)
+    except esptool.FatalError as err:
+        raise Espflasher("ESP Chip Auto-Detection failed: {}".format(err))
+
+    return chip
+
+
+def read_chip_property(func, *args, **kwargs):
+    try:
+        return prevent_print(func, *args, **kwargs)
+    except esptool.FatalError as err:
+        raise Espflasher("Reading chip details failed: {}".format(err))
+
+
+def prevent_print(func, *args, **kwargs):
+    # silenced for the calling thread only
+    try:
+        with output_to(DEVNULL):
+            return func(*args, **kwargs)
+    except serial.SerialException as err:
+        raise Espflasher("Serial port closed: {}".format(err))
+
+
+def esptool_read_mac(port, before='default_reset'):
+    chip = detect_chip(port, before)
+    try:
+        mac_address = (':'.join('{:02X}'.format(x) for x in read_chip_property(chip.read_mac)))
+    finally:
+        chip._port.close()
+    print(f'MAC - {mac_address}')
+    return mac_address.lower()
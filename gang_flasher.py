@@ -0,0 +1,137 @@
+import threading
+import re
+from concurrent.futures import ThreadPoolExecutor
+from flasher import VerifyError
+from flash_session import FlashSession
+from output_router import output_to
+
+MAC_RE = re.compile(r"^MAC: ([0-9a-fA-F:]{17})")
+
+
+class PortResult:
+    WAITING = 'Waiting'
+    FLASHING = 'Flashing'
+    PASS = 'Pass'
+    FAIL = 'Fail'
+
+    def __init__(self, port):
+        self.port = port
+        self.status = PortResult.WAITING
+        self.progress = 0
+        self.mac = None
+        self.verify = None
+        self.verify_ms = None
+        # reflash / duplicate MAC warnings, see unit_history
+        self.warnings = []
+        self.error = None
+        self.log = []
+
+
+class PortLog:
+    # per-port replacement for RedirectText, keeps the log of one port and
+    # picks the MAC out of the esptool output
+    def __init__(self, result, on_update):
+        self._result = result
+        self._on_update = on_update
+
+    def write(self, string):
+        if not string:
+            return
+        if string.startswith("\r"):
+            # esptool overwrites the current line
+            string = string[1:]
+            if self._result.log and not self._result.log[-1].endswith("\n"):
+                self._result.log.pop()
+        self._result.log.append(string)
+
+        if string.startswith("MAC: "):
+            match = MAC_RE.match(string)
+            if match:
+                self._result.mac = match.group(1).lower()
+                self._on_update(self._result)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return True
+
+
+def flash_port(config, port, progress=None, on_warning=None):
+    # returns the finished session, for its MAC and verify result
+    session = FlashSession.from_config(config, port, progress=progress, on_warning=on_warning)
+    session.flash(config.firmware_path)
+    return session
+
+
+def backend_flash_func(config):
+    # flash_port, or its worker process equivalent for config.gang_backend
+    if config.gang_backend == 'Processes':
+        from process_flasher import flash_port_in_process
+        return flash_port_in_process
+    return flash_port
+
+
+class GangFlasher:
+    # flashes the same firmware to several serial ports at once, each port
+    # gets its own progress, log and pass/fail result
+    def __init__(self, config, ports, max_workers=4, progress=None, on_update=None, on_done=None,
+                 flash_func=flash_port):
+        self._config = config
+        self.results = [PortResult(port) for port in ports]
+        self._max_workers = max(1, min(int(max_workers), len(ports) or 1))
+        self._on_update = on_update or (lambda result: None)
+        self._on_done = on_done or (lambda results: None)
+        self._flash_func = flash_func
+        # ProgressChannel shared by all ports, events carry the port name
+        self._progress = progress
+        self._thread = None
+
+    def start(self):
+        # run the pool from a helper thread so the caller (GUI) is not blocked
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="gang") as executor:
+            for result in self.results:
+                executor.submit(self._flash, result)
+        self._on_done(self.results)
+        return self.results
+
+    def _flash(self, result):
+        with output_to(PortLog(result, self._on_update)):
+            self._flash_logged(result)
+        self._on_update(result)
+
+    def _flash_logged(self, result):
+        result.status = PortResult.FLASHING
+        self._on_update(result)
+        try:
+            print("Flashing {} with {}\n".format(result.port, self._config.firmware_path))
+            session = self._flash_func(self._config, result.port, progress=self._progress,
+                                       on_warning=lambda warning: self._warn(result, warning))
+            result.mac = session.mac or result.mac
+            result.verify, result.verify_ms = session.verify, session.verify_ms()
+            result.status = PortResult.PASS
+        except (Exception, SystemExit) as e:
+            print("Unexpected error: {}".format(e))
+            result.error = str(e)
+            if isinstance(e, VerifyError):
+                result.verify, result.verify_ms = e.mode, e.verify_ms
+            result.status = PortResult.FAIL
+
+    def _warn(self, result, warning):
+        result.warnings.append(warning)
+        self._on_update(result)
+
+    def summary(self):
+        passed = sum(1 for r in self.results if r.status == PortResult.PASS)
+        return f"{passed}/{len(self.results)} passed"
@@ -0,0 +1,112 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import date
+from flasher import Espflasher, detect_chip
+from lazy import LazyModule
+
+esptool = LazyModule('esptool')
+
+# incoming inspection: identify boards straight from the ROM bootloader,
+# without uploading the stub or changing the baud rate
+#
+#   python cli.py harvest --port /dev/ttyUSB0 --port /dev/ttyUSB1 ...
+
+
+class BoardInfo:
+    def __init__(self, port):
+        self.port = port
+        self.mac = None
+        self.chip = None
+        self.revision = None
+        self.flash_size = None
+        self.crystal_mhz = None
+        self.error = None
+        self.seconds = None
+
+    def fields(self):
+        # what goes into the record store and the JSON output
+        return dict(port=self.port, mac=self.mac, chip=self.chip, revision=self.revision,
+                    flash_size=self.flash_size, crystal_mhz=self.crystal_mhz)
+
+    def __repr__(self):
+        return '<BoardInfo {} {} {}>'.format(self.port, self.mac, self.chip)
+
+
+@contextmanager
+def cached_registers(esp):
+    # MAC, chip description and revision decode overlapping eFuse words, each
+    # register is read from the chip once; only for registers that don't change
+    cache = {}
+    read_reg = esp.read_reg
+
+    def cached(addr, *args, **kwargs):
+        if addr not in cache:
+            cache[addr] = read_reg(addr, *args, **kwargs)
+        return cache[addr]
+
+    esp.read_reg = cached
+    try:
+        yield cache
+    finally:
+        del esp.read_reg
+
+
+def identify(port, before='default_reset'):
+    # one sync and about a dozen register reads per board
+    board = BoardInfo(port)
+    start = time.perf_counter()
+    esp = detect_chip(port, before)
+    try:
+        with cached_registers(esp):
+            board.mac = ':'.join('{:02x}'.format(x) for x in esp.read_mac())
+            board.chip = esp.get_chip_description()
+            if hasattr(esp, 'get_chip_revision'):
+                board.revision = esp.get_chip_revision()
+            board.crystal_mhz = esp.get_crystal_freq()
+        # the ROM leaves the SPI flash detached until told otherwise
+        esp.flash_spi_attach(0)
+        board.flash_size = esptool.DETECTED_FLASH_SIZES.get(esp.flash_id() >> 16)
+    except esptool.FatalError as err:
+        raise Espflasher("Identifying the board on {} failed: {}".format(port, err))
+    finally:
+        esp._port.close()
+    board.seconds = time.perf_counter() - start
+    return board
+
+
+class Harvester:
+    # identifies many ports at once; every board is stored and reported as
+    # soon as it is done, not when the whole batch is
+    def __init__(self, store=None, max_workers=16, before='default_reset', on_result=None):
+        # store is a RecordStore, on_result(BoardInfo) runs on the worker thread
+        self._store = store
+        self._max_workers = max(1, int(max_workers))
+        self._before = before
+        self._on_result = on_result or (lambda board: None)
+        self._lock = threading.Lock()
+        self.boards = []
+
+    def _identify(self, port):
+        try:
+            board = identify(port, self._before)
+        except (Exception, SystemExit) as e:
+            board = BoardInfo(port)
+            board.error = str(e)
+        if self._store is not None:
+            try:
+                self._store.append_inspection(str(date.today()), error=board.error, **board.fields())
+            except Exception as e:
+                print("Saving the inspection of {} failed: {}".format(port, e))
+        with self._lock:
+            self.boards.append(board)
+        self._on_result(board)
+        return board
+
+    def run(self, ports):
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, len(ports) or 1),
+                                thread_name_prefix="harvest") as executor:
+            for future in as_completed([executor.submit(self._identify, port) for port in ports]):
+                future.result()
+        return self.boards
@@ -0,0 +1,21 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    # stands in for a module that is slow to import (esptool, pylightxl) and
+    # imports it on first attribute access, so start-up doesn't pay for it;
+    # the real names are listed in hiddenimports of espflasher.spec
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
@@ -1,67 +1,32 @@
+import time
+_started = time.perf_counter()
+
 import wx
-import esptool
 import threading
-import serial
 import sys
 import os
 from config_file import FlashConfig
-from serial.tools import list_ports
-from to_excel import Excel
-
-DEVNULL = open(os.devnull, 'w')
+from to_excel import Excel, record_verify_failures
+from flasher import Espflasher, VerifyError, esptool_read_mac
+from flash_session import FlashSession
+from harvest import identify
+from manifest import Manifest, is_manifest
+from gang_flasher import GangFlasher, PortResult, backend_flash_func
+from progress import ProgressChannel, percent, describe
+from output_router import set_default_output
+from console_log import ConsoleLog
+from config_file import get_log_file_path, get_baud_file_path, get_checkpoint_file_path
+from baud_tuner import AUTO_BAUD, baud_memory
+from checkpoint import checkpoints
+from port_watcher import PortWatcher
+from prestage import prestage
+from station import Station
+from record_writer import RecordWriter
+from timing import station_timings
+from unit_history import unit_history
 
 __version__ = "0.0.4"
 __auto_select__ = "Auto-select"
-# TODO: auto-detect serial port(refer pyserial)
-
-
-class Espflasher(Exception):
-    pass
-
-
-def detect_chip(port):
-    try:
-        chip = esptool.ESPLoader.detect_chip(port)
-    except esptool.FatalError as err:
-        raise Espflasher("ESP Chip Auto-Detection failed: {}".format(err))
-
-    try:
-        chip.connect()
-    except esptool.FatalError as err:
-        raise Espflasher("Error connecting to ESP: {}".format(err))
-
-    return chip
-
-
-def read_chip_property(func, *args, **kwargs):
-    try:
-        return prevent_print(func, *args, **kwargs)
-    except esptool.FatalError as err:
-        raise Espflasher("Reading chip details failed: {}".format(err))
-
-
-def prevent_print(func, *args, **kwargs):
-    orig_sys_stdout = sys.stdout
-    sys.stdout = DEVNULL
-    try:
-        return func(*args, **kwargs)
-    except serial.SerialException as err:
-        raise Espflasher("Serial port closed: {}".format(err))
-    finally:
-        sys.stdout = orig_sys_stdout
-        pass
-
-
-def esptool_read_mac(port):
-    chip = detect_chip(port)
-    mac_address = (':'.join('{:02X}'.format(x) for x in read_chip_property(chip.read_mac)))
-    print(f'MAC - {mac_address}')
-    return mac_address.lower()
-
-
-def save_to_excel():
-    print("\nsaved to excel")
-    Excel().save_data(mac_id=MyPanel.mac_address, file_name=MyPanel.filename)
 
 
 class EspToolThread(threading.Thread):
@@ -70,29 +35,34 @@ class EspToolThread(threading.Thread):
         self.txt_ctrl = txt_ctrl
         # to exit when main thread exits
         self.daemon = True
-        # self._parent = parent
+        self._parent = parent
         self._config = config
         self.mac = None
 
     def run(self):
+        # one session for MAC read and flashing, the chip is synced only once
+        session = FlashSession.from_config(self._config, progress=self._parent.progress)
         try:
-            # self.read_mac()
-            argv = ["--port", self._config.port]
-            argv.extend(["--baud", str(self._config.baud),
-                         "--after", "hard_reset", "write_flash",
-                         "--flash_size", "detect",
-                         "--flash_mode", self._config.mode,
-                         "0x00000", self._config.firmware_path])
-
-            if self._config.erase_flash == "Yes":
-                argv.append('--erase-all')
-            print("Command: esptool.py %s\n" % " ".join(argv))
-
-            esptool.main(argv)
+            print("Flashing {} with {}\n".format(self._config.port, self._config.firmware_path))
+            session.connect()
+            self.mac = session.read_mac()
+            self._parent.watcher.index.remember(self._config.port, session.esp.CHIP_NAME, self.mac)
+            wx.CallAfter(self.txt_ctrl.SetValue, self.mac)
+            session.flash(self._config.firmware_path)
+            wx.CallAfter(self._parent.on_flash_done, self.mac, (session.verify, session.verify_ms()))
 
         except Exception as e:
             print("Unexpected error: {}".format(e))
+            self._parent.progress.post(self._config.port, 'failed', 0, 1, time.perf_counter())
+            if isinstance(e, VerifyError):
+                Excel().save_failure(e, MyPanel.filename)
+            elif self.mac and checkpoints.has(self.mac):
+                print("Written blocks are kept, flashing this board again continues after them.")
             raise e
+        finally:
+            session.close()
+            # the next board goes on the same port
+            prestage.open_port(self._config.port)
 
     def read_mac(self):
         # read mac and update to UI
@@ -101,24 +71,13 @@ class EspToolThread(threading.Thread):
 
 
 class RedirectText:
-    def __init__(self, text_ctrl):
-        self.__out = text_ctrl
+    # stdout goes into the bounded ConsoleLog, MyPanel copies it into the
+    # console widget from its timer
+    def __init__(self, console_log):
+        self.__out = console_log
 
     def write(self, string):
-        if string.startswith("\rWriting at"):
-            current_value = string[-6:-3]
-            import re
-            percentage = re.findall(r"\d+", current_value)
-            MyPanel.on_progress(percentage[0])
-
-        if string.startswith("\r"):
-            current_value = self.__out.GetValue()
-            last_newline = current_value.rfind("\n")
-            new_value = current_value[:last_newline + 1]  # preserve \n
-            new_value += string[1:]  # chop off leading \r
-            wx.CallAfter(self.__out.SetValue, new_value)
-        else:
-            wx.CallAfter(self.__out.AppendText, string)
+        self.__out.write(string)
 
     def flush(self):
         # noinspection PyStatementEffect
@@ -134,15 +93,45 @@ class RedirectText:
 
 class MyPanel(wx.Panel):
     filename = ''
-    mac_address = ''
+    # MAC and (verify mode, verify ms) of the last board that passed, what Save records
+    passed_mac = ''
+    passed_verify = (None, None)
     gauge = None
     upload_status_label = None
 
-    def __init__(self, parent):
+    def __init__(self, parent, config):
         super(MyPanel, self).__init__(parent)
 
-        self._config = FlashConfig.load()
+        self._config = config
         self.auto_save_state = False
+        self.gang_ports = []
+        self.gang = None
+        # port -> list row of the running gang, fixed when the run starts
+        self.gang_rows = {}
+        # station mode: boards plugged in go through the whole pipeline on their own
+        self.station = None
+        self.station_rows = {}
+        # flash workers post progress and console output here, the timer
+        # below moves both into the widgets at ~30 Hz
+        self.progress = ProgressChannel()
+        self.console_log = ConsoleLog()
+        if self._config.log_to_file == "Yes":
+            self.console_log.spill_to(get_log_file_path())
+        # best auto baud per USB bridge, carried over to the next session
+        baud_memory.open(get_baud_file_path())
+        # blocks confirmed on boards whose flashing was interrupted
+        checkpoints.open(get_checkpoint_file_path())
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
+        self.timer.Start(33)
+        # records are saved off the GUI thread
+        self.writer = RecordWriter(lambda records: Excel().save_batch(records),
+                                   on_saved=lambda saved, failed: wx.CallAfter(self.on_saved, saved, failed))
+        self.writer.start()
+        # keeps the port list current, attach/detach arrive on the GUI thread
+        self.watcher = PortWatcher(on_attach=lambda port: wx.CallAfter(self.on_port_attach, port),
+                                   on_detach=lambda port: wx.CallAfter(self.on_port_detach, port))
+        self.watcher.start()
 
         # labels
         port_label = wx.StaticText(self, label='Serial Port')
@@ -159,11 +148,17 @@ class MyPanel(wx.Panel):
         reload_button.Bind(wx.EVT_BUTTON, self.on_reload)
         reload_button.SetToolTip("Reload serial device list")
 
+        gang_button = wx.Button(self, label="Gang...")
+        gang_button.Bind(wx.EVT_BUTTON, self.on_gang)
+        gang_button.SetToolTip("Select several serial ports to flash at once")
+
         serial_boxsizer = wx.BoxSizer(wx.HORIZONTAL)
         serial_boxsizer.Add(self.choice, 1, wx.EXPAND)
         serial_boxsizer.Add(reload_button, flag=wx.LEFT, border=10)
+        serial_boxsizer.Add(gang_button, flag=wx.LEFT, border=10)
 
-        file_picker = wx.FilePickerCtrl(self, style=wx.FLP_USE_TEXTCTRL)
+        file_picker = wx.FilePickerCtrl(self, style=wx.FLP_USE_TEXTCTRL,
+                                        wildcard="Firmware or manifest (*.bin;*.json)|*.bin;*.json|All files|*.*")
         file_picker.Bind(wx.EVT_FILEPICKER_CHANGED, self.on_pick_file)
 
         upload_button = wx.Button(self, label="Upload Firmware")
@@ -198,13 +193,24 @@ class MyPanel(wx.Panel):
         self.console_ctrl.SetForegroundColour(wx.BLUE)
         self.console_ctrl.SetDefaultStyle(wx.TextAttr(wx.BLUE))
 
-        sys.stdout = RedirectText(self.console_ctrl)
+        # output of threads without a sink of their own (see output_router)
+        set_default_output(RedirectText(self.console_log))
+
+        # one row per port while gang flashing
+        self.gang_list = wx.ListCtrl(self, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        for col, (heading, width) in enumerate([('Port', 110), ('MAC', 130), ('Progress', 70), ('Result', 200)]):
+            self.gang_list.InsertColumn(col, heading, width=width)
+        self.gang_list.Hide()
 
         save_to_label = wx.StaticText(self, label='Save to Excel')
 
         auto_save_checkbox = wx.CheckBox(self, label="Auto Save")
         auto_save_checkbox.Bind(wx.EVT_CHECKBOX, self.on_auto_save)
 
+        station_checkbox = wx.CheckBox(self, label="Station Mode")
+        station_checkbox.Bind(wx.EVT_CHECKBOX, self.on_station_mode)
+        station_checkbox.SetToolTip("Flash, verify and save every board as soon as it is plugged in")
+
         self.save_button = wx.Button(self, label="Save")
         self.save_button.Bind(wx.EVT_BUTTON, self.on_save)
         self.save_button.Disable()
@@ -217,9 +223,10 @@ class MyPanel(wx.Panel):
         flex_grid.AddGrowableRow(4, 1)
         flex_grid.AddGrowableCol(1, 1)
         hbox.Add(flex_grid, proportion=2, flag=wx.ALL | wx.EXPAND, border=15)
+        hbox.Add(self.gang_list, 1, wx.LEFT | wx.RIGHT | wx.BOTTOM | wx.EXPAND, 15)
 
-        grid_sizer = wx.GridSizer(1, 3, 10, 10)
-        grid_sizer.AddMany([save_to_label, auto_save_checkbox, self.save_button])
+        grid_sizer = wx.GridSizer(1, 4, 10, 10)
+        grid_sizer.AddMany([save_to_label, auto_save_checkbox, self.save_button, station_checkbox])
         hbox.Add(grid_sizer, 0, wx.LEFT | wx.RIGHT | wx.BOTTOM | wx.EXPAND, 15)
 
         self.SetSizer(hbox)
@@ -231,12 +238,32 @@ class MyPanel(wx.Panel):
             wx.MessageBox("No Port Selected !", caption="Select Port", style=wx.OK | wx.ICON_ERROR)
         else:
             self.mac_text_ctrl.SetValue("")
-            mac_add = esptool_read_mac(self._config.port)
-            self.mac_text_ctrl.SetValue(mac_add)
-            MyPanel.mac_address = mac_add
+            # a board only identified is not saved, nor is the last passed one once another is connected
+            self.save_button_state(False)
+            # the sync takes a while, the GUI thread only gets the result
+            threading.Thread(target=self._identify, args=(self._config.port,), daemon=True).start()
             # wx.MessageBox("Please reconnect the device or restart the App !", caption="Reconnect", style=wx.OK |
             # wx.ICON_WARNING)
 
+    def _identify(self, port):
+        # identify() opens the port by name
+        prestage.release_port(port)
+        try:
+            board = identify(port, self._config.before)
+        except Exception as e:
+            print("Unexpected error: {}".format(e))
+            return
+        finally:
+            prestage.open_port(port)
+        print('{} rev {}, {} flash, {} MHz crystal'.format(board.chip, board.revision, board.flash_size,
+                                                          board.crystal_mhz))
+        print(f'MAC - {board.mac.upper()}')
+        wx.CallAfter(self.on_identified, board)
+
+    def on_identified(self, board):
+        self.mac_text_ctrl.SetValue(board.mac)
+        self.watcher.index.remember(board.port, board.chip, board.mac)
+
     def on_upload(self, event):
         MyPanel.gauge.Show()
         MyPanel.upload_status_label.Hide()
@@ -246,39 +273,214 @@ class MyPanel(wx.Panel):
         elif self._config.firmware_path is None:
             print('no file is selected')
             wx.MessageBox("No file is selected !", caption="Select Firmware", style=wx.OK | wx.ICON_ERROR)
+        elif self.gang_ports:
+            self._start_gang()
         else:
             print('Uploading...')
             print(self._config.port + ', ' + str(self._config.baud) + ", " + self._config.firmware_path)
-            self.on_read_mac()
-            self.console_ctrl.SetValue("")
+            self.console_log.clear()
+            self.mac_text_ctrl.SetValue("")
+            self.save_button_state(False)
+            self._open_history()
             worker = EspToolThread(self, self._config, self.mac_text_ctrl)
             worker.start()
             # worker.join()
-            self.save_button_state(True)
-            if self.auto_save_state:
-                save_to_excel()
+
+    @staticmethod
+    def _open_history():
+        # the record store a MAC is looked up in before its board is flashed
+        unit_history.open(Excel().store.path)
+
+    def on_flash_done(self, mac, verify_result):
+        MyPanel.passed_mac = mac
+        MyPanel.passed_verify = verify_result
+        self.save_button_state(True)
+        if self.auto_save_state:
+            self.save_record(MyPanel.passed_mac, *MyPanel.passed_verify)
+
+    def save_record(self, mac_id, verify=None, verify_ms=None):
+        print("\nsaving to excel")
+        self.writer.put(mac_id, MyPanel.filename, verify, verify_ms)
+
+    def on_saved(self, saved, failed):
+        for sl_no, (mac_id, *_) in saved:
+            print(f"saved to excel: {sl_no}, {mac_id}")
+        if failed:
+            wx.MessageBox("{} record(s) could not be saved, see console".format(len(failed)),
+                          caption="Save to Excel", style=wx.OK | wx.ICON_ERROR)
 
     def on_pick_file(self, event):
         self._config.firmware_path = event.GetPath().replace("'", "")
         print('Firmware path: ' + self._config.firmware_path)
         MyPanel.filename = os.path.basename(self._config.firmware_path)
         print(MyPanel.filename)
+        if is_manifest(self._config.firmware_path):
+            try:
+                print(Manifest.load(self._config.firmware_path).describe())
+            except Espflasher as e:
+                self._config.firmware_path = None
+                wx.MessageBox(str(e), caption="Select Firmware", style=wx.OK | wx.ICON_ERROR)
+                return
+        # checked and compressed while the board is being connected
+        prestage.stage_firmware(self._config, on_done=lambda warnings: wx.CallAfter(self.on_prestaged, warnings))
+
+    def on_prestaged(self, warnings):
+        if warnings:
+            wx.MessageBox("\n".join(warnings), caption="Select Firmware", style=wx.OK | wx.ICON_WARNING)
 
     def on_select_port(self, event):
         choice = event.GetEventObject()
+        if self._gang_running():
+            choice.SetSelection(wx.NOT_FOUND)
+            return
         self._config.port = choice.GetString(choice.GetSelection())
         print("Port: " + self._config.port)
+        self._set_gang_ports([])
+        prestage.open_port(self._config.port)
+
+    def on_gang(self, event):
+        if self._gang_running():
+            return
+        ports = self._get_serial_ports()
+        dialog = wx.MultiChoiceDialog(self, "Ports to flash at once", "Gang Flashing", ports)
+        dialog.SetSelections([ports.index(p) for p in self.gang_ports if p in ports])
+        if dialog.ShowModal() == wx.ID_OK:
+            self._set_gang_ports([ports[i] for i in dialog.GetSelections()])
+        dialog.Destroy()
+
+    def _set_gang_ports(self, ports):
+        self.gang_ports = ports
+        self.gang_rows = {}
+        self.gang_list.DeleteAllItems()
+        for row, port in enumerate(ports):
+            self.gang_list.InsertItem(row, port)
+            self.gang_list.SetItem(row, 3, PortResult.WAITING)
+        self.gang_list.Show(bool(ports))
+        # gang workers (processes too) open their ports by name
+        prestage.release_port()
+        if ports:
+            # port itself is still the "port" in config, gang list is used on upload
+            self.choice.SetSelection(wx.NOT_FOUND)
+            self._config.port = ports[0]
+            print("Gang ports: " + ", ".join(ports))
+        self.Layout()
+
+    def _gang_running(self):
+        # the gang list belongs to the run until it is done
+        if self.gang is not None and self.gang.is_alive():
+            print("gang flashing is still running")
+            return True
+        return False
+
+    def _start_gang(self):
+        if self._gang_running():
+            return
+        print('Gang uploading to {} ports...'.format(len(self.gang_ports)))
+        MyPanel.gauge.SetValue(0)
+        self._set_gang_ports(self.gang_ports)
+        self.gang_rows = {port: row for row, port in enumerate(self.gang_ports)}
+        self._open_history()
+        self.gang = GangFlasher(self._config, self.gang_ports, max_workers=self._config.gang_workers,
+                                progress=self.progress, flash_func=record_verify_failures(backend_flash_func(self._config)),
+                                on_update=lambda result: wx.CallAfter(self._on_gang_update, result),
+                                on_done=lambda results: wx.CallAfter(self._on_gang_done, results))
+        self.gang.start()
+
+    def _on_gang_update(self, result):
+        row = self.gang_rows[result.port]
+        self.gang_list.SetItem(row, 1, result.mac or '')
+        self.gang_list.SetItem(row, 3, result.error or self._with_warning(result.status, result.warnings))
+        if result.mac:
+            self.watcher.index.remember(result.port, mac=result.mac)
+        if result.status == PortResult.PASS and self.auto_save_state:
+            self.save_record(result.mac, result.verify, result.verify_ms)
+
+    @staticmethod
+    def _with_warning(text, warnings):
+        # reflash / duplicate MAC warning of the board, see unit_history
+        return '{} ({})'.format(text, warnings[-1]) if warnings else text
+
+    def _on_gang_done(self, results):
+        for result in results:
+            if result.status == PortResult.FAIL:
+                print("\n--- {} ---\n{}".format(result.port, "".join(result.log)))
+        MyPanel.gauge.Hide()
+        MyPanel.gauge.SetValue(0)
+        MyPanel.upload_status_label.Show()
+        MyPanel.upload_status_label.SetLabel("Gang: " + self.gang.summary())
+        self.Layout()
 
     def on_reload(self, event):
         print('port reload')
-        self.choice.SetItems(self._get_serial_ports())
+        self.watcher.scan()
 
-    @staticmethod
-    def _get_serial_ports():
-        ports = []
-        for port, desc, hwid in sorted(list_ports.comports()):
-            ports.append(port)
-        return ports
+    def _get_serial_ports(self):
+        return self.watcher.index.devices()
+
+    def _refresh_ports(self):
+        selected = self.choice.GetStringSelection()
+        self.choice.SetItems(self._get_serial_ports())
+        if selected:
+            self.choice.SetStringSelection(selected)
+
+    def on_port_attach(self, port):
+        seen = ' (last seen: {} {})'.format(port.chip, port.mac) if port.mac else ''
+        print('Port attached: {} {}{}'.format(port.device, port.description, seen))
+        self._refresh_ports()
+        if self.station is not None:
+            self.station.add(port.device)
+        elif port.device == self._config.port and not self.gang_ports:
+            prestage.open_port(port.device)
+
+    def on_port_detach(self, port):
+        print('Port detached: {}'.format(port.device))
+        prestage.release_port(port.device)
+        self._refresh_ports()
+
+    def on_station_mode(self, event):
+        cb = event.GetEventObject()
+        if not cb.GetValue():
+            if self.station is not None:
+                self.station.shutdown(wait=False)
+            self.station = None
+            print("Station mode off")
+            return
+        if self._config.firmware_path is None:
+            cb.SetValue(False)
+            wx.MessageBox("No file is selected !", caption="Select Firmware", style=wx.OK | wx.ICON_ERROR)
+            return
+        if self._gang_running():
+            cb.SetValue(False)
+            return
+        self._set_gang_ports([])
+        self.station_rows = {}
+        self.gang_list.DeleteAllItems()
+        self.gang_list.Show()
+        self.Layout()
+        # records are stored by the pipeline itself, before the board counts as done
+        self._open_history()
+        self.station = Station(self._config, lambda *record: Excel().save_data(*record),
+                               max_workers=self._config.gang_workers, progress=self.progress,
+                               on_update=lambda job: wx.CallAfter(self._on_station_update, job),
+                               persist_failure=lambda error, file_name: Excel().save_failure(error, file_name))
+        print("Station mode on, plug in boards to flash " + self._config.firmware_path)
+
+    def _on_station_update(self, job):
+        # one row per port, the next board on the same port reuses it
+        if job.port not in self.station_rows:
+            self.station_rows[job.port] = self.gang_list.GetItemCount()
+            self.gang_list.InsertItem(self.station_rows[job.port], job.port)
+        row = self.station_rows[job.port]
+        self.gang_list.SetItem(row, 1, job.mac or '')
+        if job.stage == 'done':
+            self.gang_list.SetItem(row, 3, self._with_warning("Done, Sl-No {}".format(job.sl_no), job.warnings))
+            self.watcher.index.remember(job.port, job.chip, job.mac)
+        else:
+            self.gang_list.SetItem(row, 3, job.error or self._with_warning(job.stage.capitalize(), job.warnings))
+        if job.finished is not None and self.station is not None:
+            MyPanel.upload_status_label.Show()
+            MyPanel.upload_status_label.SetLabel("Station: " + self.station.summary())
+            self.Layout()
 
     # saves data to excel whenever firmware is uploaded
     def on_auto_save(self, event):
@@ -290,7 +492,7 @@ class MyPanel(wx.Panel):
     # saves data to exel only when save is pressed
     def on_save(self, event):
         print("on save")
-        save_to_excel()
+        self.save_record(MyPanel.passed_mac, *MyPanel.passed_verify)
         self.save_button_state(False)
 
     def save_button_state(self, state):
@@ -300,29 +502,59 @@ class MyPanel(wx.Panel):
         else:
             self.save_button.Enable(state)
 
-    @staticmethod
-    def on_progress(value):
-        MyPanel.gauge.SetValue(int(value))
-        if int(value) == 100:
-            import time
-            time.sleep(1)
-            MyPanel.gauge.Hide()
-            MyPanel.gauge.SetValue(0)
-            MyPanel.upload_status_label.Show()
-            MyPanel.upload_status_label.SetLabel("Done Uploading")
+    def on_timer(self, event):
+        self.on_progress()
+        self.on_console()
+
+    def on_console(self):
+        text = self.console_log.take()
+        if text is not None:
+            self.console_ctrl.ChangeValue(text)
+            self.console_ctrl.ShowPosition(self.console_ctrl.GetLastPosition())
+
+    def on_progress(self):
+        # runs on the GUI thread, only the latest event of each port matters
+        for progress in self.progress.drain():
+            if progress.port in self.gang_rows:
+                self._on_gang_progress(progress)
+            elif progress.port in self.station_rows:
+                self.gang_list.SetItem(self.station_rows[progress.port], 2, describe(progress))
+            elif progress.phase == 'done':
+                MyPanel.gauge.Hide()
+                MyPanel.gauge.SetValue(0)
+                MyPanel.upload_status_label.Show()
+                MyPanel.upload_status_label.SetLabel("Done Uploading")
+            elif progress.phase == 'failed':
+                MyPanel.gauge.SetValue(0)
+                MyPanel.upload_status_label.Show()
+                MyPanel.upload_status_label.SetLabel("Upload failed")
+            else:
+                MyPanel.gauge.SetValue(percent(progress))
+                MyPanel.upload_status_label.Show()
+                MyPanel.upload_status_label.SetLabel(describe(progress))
+                self.Layout()
+
+    def _on_gang_progress(self, progress):
+        row = self.gang_rows[progress.port]
+        result = self.gang.results[row]
+        result.progress = percent(progress) if progress.phase == 'write' else result.progress
+        self.gang_list.SetItem(row, 2, describe(progress))
+        # overall gauge follows the slowest port
+        MyPanel.gauge.SetValue(min(r.progress for r in self.gang.results))
 
 class SettingsTab(wx.Panel):
-    def __init__(self, parent):
+    def __init__(self, parent, config):
         wx.Panel.__init__(self, parent)
 
-        self._config = FlashConfig.load()
+        # same FlashConfig as MyPanel, changes apply to the next upload
+        self._config = config
 
         hbox = wx.BoxSizer(wx.HORIZONTAL)
 
         flex_grid = wx.FlexGridSizer(6, 1, 10, 10)
 
         # radio box for baud-rate selection
-        baud_rate_list = ['9600', '57600', '74880', '115200', '230400', '460800', '921600']
+        baud_rate_list = ['9600', '57600', '74880', '115200', '230400', '460800', '921600', AUTO_BAUD]
         baud_box = wx.RadioBox()
         baud_box.Create(self, label='Baud Rate', choices=baud_rate_list,
                         majorDimension=1, style=wx.RA_SPECIFY_ROWS)
@@ -354,12 +586,67 @@ class SettingsTab(wx.Panel):
         erase_box.SetSelection(e_index)
         erase_box.Bind(wx.EVT_RADIOBOX, self.on_erase)
 
+        # radio box for keeping the console log on disk
+        log_list = ['No', 'Yes']
+        log_box = wx.RadioBox()
+        log_box.Create(self, label='Log to File', choices=log_list,
+                       majorDimension=1, style=wx.RA_SPECIFY_ROWS)
+        log_box.SetSelection(log_list.index(self._config.log_to_file))
+        log_box.Bind(wx.EVT_RADIOBOX, self.on_log_to_file)
+
+        # radio box for differential flashing (only changed chunks are written)
+        diff_list = ['No', 'Yes']
+        diff_box = wx.RadioBox()
+        diff_box.Create(self, label='Diff Flash', choices=diff_list,
+                        majorDimension=1, style=wx.RA_SPECIFY_ROWS)
+        diff_box.SetSelection(diff_list.index(self._config.diff_flash))
+        diff_box.Bind(wx.EVT_RADIOBOX, self.on_diff_flash)
+
+        # radio box for the post-flash check: stub MD5 only, or MD5 plus sampled sector readback
+        verify_list = ['Hash', 'Paranoid']
+        verify_box = wx.RadioBox()
+        verify_box.Create(self, label='Verify', choices=verify_list,
+                          majorDimension=1, style=wx.RA_SPECIFY_ROWS)
+        verify_box.SetSelection(verify_list.index(self._config.verify))
+        verify_box.Bind(wx.EVT_RADIOBOX, self.on_verify)
+
+        # radio box for continuing an interrupted upload after its last confirmed block
+        resume_list = ['No', 'Yes']
+        resume_box = wx.RadioBox()
+        resume_box.Create(self, label='Resume', choices=resume_list,
+                          majorDimension=1, style=wx.RA_SPECIFY_ROWS)
+        resume_box.SetSelection(resume_list.index(self._config.resume))
+        resume_box.Bind(wx.EVT_RADIOBOX, self.on_resume)
+
         box1 = wx.BoxSizer(wx.HORIZONTAL)
         box1.Add(erase_box, flag=wx.RIGHT, border=10)
-        box1.Add(mode_box, flag=wx.LEFT, border=10)
+        box1.Add(diff_box, flag=wx.LEFT | wx.RIGHT, border=10)
+        box1.Add(mode_box, flag=wx.LEFT | wx.RIGHT, border=10)
+        box1.Add(log_box, flag=wx.LEFT | wx.RIGHT, border=10)
+        box1.Add(verify_box, flag=wx.LEFT | wx.RIGHT, border=10)
+        box1.Add(resume_box, flag=wx.LEFT, border=10)
+
+        # number of ports flashed at the same time in gang mode
+        workers_label = wx.StaticText(self, label='Gang Workers')
+        workers_spin = wx.SpinCtrl(self, min=1, max=32, initial=int(self._config.gang_workers))
+        workers_spin.Bind(wx.EVT_SPINCTRL, self.on_gang_workers)
+
+        # radio box for running every gang port in its own process instead of a thread
+        backend_list = ['Threads', 'Processes']
+        backend_box = wx.RadioBox()
+        backend_box.Create(self, label='Gang Backend', choices=backend_list,
+                           majorDimension=1, style=wx.RA_SPECIFY_ROWS)
+        backend_box.SetSelection(backend_list.index(self._config.gang_backend))
+        backend_box.Bind(wx.EVT_RADIOBOX, self.on_gang_backend)
+
+        box2 = wx.BoxSizer(wx.HORIZONTAL)
+        box2.Add(workers_label, flag=wx.RIGHT | wx.ALIGN_CENTER_VERTICAL, border=10)
+        box2.Add(workers_spin)
+        box2.Add(backend_box, flag=wx.LEFT, border=20)
 
         flex_grid.AddMany([baud_box,
                            (box1, 1, wx.EXPAND),
+                           box2,
                            save_button])
         flex_grid.AddGrowableRow(5, 1)
         flex_grid.AddGrowableCol(0, 1)
@@ -384,9 +671,33 @@ class SettingsTab(wx.Panel):
         self._config.erase_flash = e.GetStringSelection()
         print('erase: ' + str(self._config.erase_flash))
 
+    def on_diff_flash(self, event):
+        self._config.diff_flash = event.GetEventObject().GetStringSelection()
+        print('diff flash: ' + str(self._config.diff_flash))
+
+    def on_verify(self, event):
+        self._config.verify = event.GetEventObject().GetStringSelection()
+        print('verify: ' + str(self._config.verify))
+
+    def on_resume(self, event):
+        self._config.resume = event.GetEventObject().GetStringSelection()
+        print('resume: ' + str(self._config.resume))
+
+    def on_log_to_file(self, event):
+        self._config.log_to_file = event.GetEventObject().GetStringSelection()
+        print('log to file: {} (applies after restart)'.format(self._config.log_to_file))
+
+    def on_gang_workers(self, event):
+        self._config.gang_workers = event.GetEventObject().GetValue()
+        print('gang workers: ' + str(self._config.gang_workers))
+
+    def on_gang_backend(self, event):
+        self._config.gang_backend = event.GetEventObject().GetStringSelection()
+        print('gang backend: ' + str(self._config.gang_backend))
+
     def on_save(self, event):
         print(f'mode:{self._config.mode}, baud rate:{self._config.baud},'
-              f'erase:{self._config.erase_flash}')
+              f'erase:{self._config.erase_flash}, gang workers:{self._config.gang_workers}')
         self._config.save()
 
 
@@ -407,8 +718,13 @@ class ExeclTab(wx.Panel):
         save_button = wx.Button(self, label="Save", pos=(20, 30))
         save_button.Bind(wx.EVT_BUTTON, self.on_save)
 
+        # records are logged as they come, the workbook is written on demand
+        export_button = wx.Button(self, label="Export")
+        export_button.Bind(wx.EVT_BUTTON, self.on_export)
+        export_button.SetToolTip("Write all saved records to the Excel file now")
+
         flex_grid.AddMany([save_to_label, (dir_picker, 1, wx.EXPAND),
-                           save_button])
+                           save_button, export_button])
         flex_grid.AddGrowableRow(5, 1)
         flex_grid.AddGrowableCol(1, 1)
 
@@ -419,11 +735,110 @@ class ExeclTab(wx.Panel):
         print("Saved")
         Excel().set_output_path(self.output_file_path)
 
+    def on_export(self, event):
+        # the whole history is written, off the GUI thread
+        threading.Thread(target=self._export, daemon=True).start()
+
+    @staticmethod
+    def _export():
+        try:
+            Excel().export()
+        except Exception as e:
+            print("Excel export failed: {}".format(e))
+
     def on_pick_dir(self, event):
         self.output_file_path = event.GetPath()
         print(f'path: {self.output_file_path}')
 
 
+class StatsTab(wx.Panel):
+    # live per-phase timing of all boards flashed in this session
+    def __init__(self, parent):
+        wx.Panel.__init__(self, parent)
+
+        vbox = wx.BoxSizer(wx.VERTICAL)
+
+        self.units_label = wx.StaticText(self, label='')
+
+        self.stats_list = wx.ListCtrl(self, style=wx.LC_REPORT)
+        columns = [('Phase', 90), ('Count', 55), ('Mean s', 65), ('p50 s', 65), ('p90 s', 65), ('p99 s', 65),
+                   ('Max s', 65)]
+        for col, (heading, width) in enumerate(columns):
+            self.stats_list.InsertColumn(col, heading, width=width)
+
+        csv_button = wx.Button(self, label="Export CSV")
+        csv_button.Bind(wx.EVT_BUTTON, self.on_export_csv)
+        prometheus_button = wx.Button(self, label="Export Prometheus")
+        prometheus_button.Bind(wx.EVT_BUTTON, self.on_export_prometheus)
+        reset_button = wx.Button(self, label="Reset")
+        reset_button.Bind(wx.EVT_BUTTON, self.on_reset)
+
+        button_box = wx.BoxSizer(wx.HORIZONTAL)
+        button_box.Add(csv_button, flag=wx.RIGHT, border=10)
+        button_box.Add(prometheus_button, flag=wx.RIGHT, border=10)
+        button_box.Add(reset_button)
+
+        vbox.Add(self.units_label, 0, wx.ALL | wx.EXPAND, 15)
+        vbox.Add(self.stats_list, 1, wx.LEFT | wx.RIGHT | wx.EXPAND, 15)
+        vbox.Add(button_box, 0, wx.ALL, 15)
+        self.SetSizer(vbox)
+
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
+        self.timer.Start(1000)
+        self.refresh()
+
+    def on_timer(self, event):
+        if self.IsShownOnScreen():
+            self.refresh()
+
+    def refresh(self):
+        self.stats_list.DeleteAllItems()
+        for row, (phase, count, *values) in enumerate(station_timings.stats()):
+            self.stats_list.InsertItem(row, phase)
+            self.stats_list.SetItem(row, 1, str(count))
+            for col, value in enumerate(values, start=2):
+                self.stats_list.SetItem(row, col, '{:.3f}'.format(value))
+        passed, failed = station_timings.units()
+        self.units_label.SetLabel('{} passed, {} failed, {:.0f} units/h'.format(
+            passed, failed, station_timings.units_per_hour()))
+
+    def _ask_path(self, message, wildcard):
+        with wx.FileDialog(self, message, wildcard=wildcard, style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dialog:
+            return dialog.GetPath() if dialog.ShowModal() == wx.ID_OK else None
+
+    def on_export_csv(self, event):
+        path = self._ask_path("Export timing spans", "CSV (*.csv)|*.csv")
+        if path:
+            station_timings.to_csv(path)
+            print(f"Timing spans exported to {path}")
+
+    def on_export_prometheus(self, event):
+        path = self._ask_path("Export timing metrics", "Prometheus text (*.prom)|*.prom")
+        if path:
+            with open(path, 'w') as f:
+                f.write(station_timings.to_prometheus())
+            print(f"Timing metrics exported to {path}")
+
+    def on_reset(self, event):
+        station_timings.reset()
+        self.refresh()
+
+
+class LazyTab(wx.Panel):
+    # notebook page whose content is only built when it is first shown
+    def __init__(self, parent, build):
+        wx.Panel.__init__(self, parent)
+        self._build = build
+        self.SetSizer(wx.BoxSizer(wx.VERTICAL))
+
+    def build(self):
+        if self._build is not None:
+            self.GetSizer().Add(self._build(self), 1, wx.EXPAND)
+            self._build = None
+            self.Layout()
+
+
 class EspFlasher(wx.Frame):
     def __init__(self, parent, title):
         super(EspFlasher, self).__init__(parent, title=title, size=(550, 550))
@@ -434,14 +849,20 @@ class EspFlasher(wx.Frame):
         self.Center(wx.BOTH)
         notebook = wx.Notebook(self)
 
-        tab1 = MyPanel(notebook)
-        tab2 = SettingsTab(notebook)
-        tab3 = ExeclTab(notebook)
+        # loaded once, shared by all tabs
+        self.config = FlashConfig.load()
+        self.main_panel = tab1 = MyPanel(notebook, self.config)
+        tab2 = LazyTab(notebook, lambda parent: SettingsTab(parent, self.config))
+        tab3 = LazyTab(notebook, ExeclTab)
+        tab4 = LazyTab(notebook, StatsTab)
 
         notebook.AddPage(tab1, "Main")
         notebook.AddPage(tab2, "Settings")
         notebook.AddPage(tab3, "Execl")
+        notebook.AddPage(tab4, "Stats")
+        notebook.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self._on_page_changed)
 
+        self.Bind(wx.EVT_CLOSE, self._on_close)
         # self.panel = MyPanel(self)
         # self._menu_bar()
 
@@ -464,6 +885,21 @@ class EspFlasher(wx.Frame):
         self.Bind(wx.EVT_MENU, self._on_settings, item)
         self.SetMenuBar(self.menuBar)
 
+    def _on_close(self, event):
+        # finish pending saves; the records are in the store, the workbook is
+        # only written by Export (Excel tab) or cli.py history --export
+        self.main_panel.watcher.stop()
+        if self.main_panel.station is not None:
+            self.main_panel.station.shutdown()
+        self.main_panel.writer.stop()
+        event.Skip()
+
+    def _on_page_changed(self, event):
+        page = event.GetEventObject().GetPage(event.GetSelection())
+        if isinstance(page, LazyTab):
+            page.build()
+        event.Skip()
+
     def _on_exit(self, event):
         self.Close()
 
@@ -472,19 +908,47 @@ class EspFlasher(wx.Frame):
 
 
 class MyApp(wx.App):
+    def __init__(self, startup_budget=None):
+        # with a budget the app only measures time to first frame and exits
+        self.startup_budget = startup_budget
+        self.exit_code = 0
+        wx.App.__init__(self)
+
     def OnInit(self):
         self.SetAppName("ESP Flasher")
         frame = EspFlasher(parent=None, title='ESP Flasher')
         frame.Show()
+        # runs once the event loop is up, i.e. the frame is on screen
+        wx.CallAfter(self.on_first_frame, frame)
 
         return True
 
-
-def main():
-    app = MyApp()
+    def on_first_frame(self, frame):
+        elapsed = time.perf_counter() - _started
+        report = 'Startup: first frame after {:.3f} s'.format(elapsed)
+        if self.startup_budget is not None and elapsed > self.startup_budget:
+            report += ', budget of {:.3f} s exceeded'.format(self.startup_budget)
+            self.exit_code = 1
+        print(report)
+        # stdout is the console tab by now; the windowed exe has no real one
+        if sys.__stdout__ is not None:
+            sys.__stdout__.write(report + '\n')
+        if self.startup_budget is not None:
+            frame.Close()
+
+
+def main(argv=None):
+    # --startup-budget SECONDS: start, report time to first frame and exit
+    # non-zero if it took longer (startup benchmark for the frozen exe)
+    argv = sys.argv[1:] if argv is None else argv
+    budget = None
+    if argv[:1] == ['--startup-budget'] and len(argv) == 2:
+        budget = float(argv[1])
+    app = MyApp(startup_budget=budget)
     app.MainLoop()
+    return app.exit_code
 
 
 if __name__ == '__main__':
     __name__ = 'main'
-    main()
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import json
+import os
+from flasher import Espflasher
+
+# manifest example, file names are relative to the manifest:
+# {
+#     "segments": [
+#         {"offset": "0x1000", "file": "bootloader.bin"},
+#         {"offset": "0x8000", "file": "partition-table.bin"},
+#         {"offset": "0xe000", "file": "ota_data_initial.bin"},
+#         {"offset": "0x10000", "file": "app.bin"},
+#         {"offset": "0x290000", "file": "spiffs.bin"}
+#     ],
+#     "chips": {
+#         "ESP8266": {"segments": [{"offset": "0x0", "file": "app-esp8266.bin"}]}
+#     }
+# }
+# ESP-IDF's build/flasher_args.json ("flash_files": {"0x1000": ...}) works as well.
+
+
+def is_manifest(path):
+    return bool(path) and path.lower().endswith('.json')
+
+
+def _offset(value):
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+class Manifest:
+    def __init__(self, path, segments, chips=None):
+        self.path = path
+        # default [(offset, file)], and per chip name variants
+        self.segments = segments
+        self.chips = chips or {}
+
+    @classmethod
+    def single(cls, firmware_path, offset=0x0):
+        # a plain .bin is a manifest with one segment
+        return cls(firmware_path, [(offset, firmware_path)])
+
+    @classmethod
+    def load(cls, path):
+        if not is_manifest(path):
+            return cls.single(path)
+        base = os.path.dirname(os.path.abspath(path))
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as err:
+            raise Espflasher("Reading manifest {} failed: {}".format(path, err))
+
+        def parse(section):
+            if 'flash_files' in section:
+                items = section['flash_files'].items()
+            else:
+                items = [(segment['offset'], segment['file']) for segment in section.get('segments', [])]
+            segments = [(_offset(offset), os.path.join(base, file)) for offset, file in items]
+            return cls._check(path, segments)
+
+        chips = {name.upper(): parse(section) for name, section in data.get('chips', {}).items()}
+        return cls(path, parse(data), chips)
+
+    @staticmethod
+    def _check(path, segments):
+        # written in address order so every sector is erased once, overlaps are an error
+        segments = sorted(segments)
+        end = 0
+        for offset, file in segments:
+            if not os.path.isfile(file):
+                raise Espflasher("{}: file {} not found".format(path, file))
+            if offset < end:
+                raise Espflasher("{}: {} at 0x{:x} overlaps the previous segment".format(path, file, offset))
+            end = offset + os.path.getsize(file)
+        return segments
+
+    def segments_for(self, chip_name):
+        segments = self.chips.get(chip_name.upper(), self.segments)
+        if not segments:
+            raise Espflasher("{}: no segments for {}".format(self.path, chip_name))
+        return segments
+
+    def files(self):
+        # every file of every chip variant, once
+        files = [file for _, file in self.segments]
+        for segments in self.chips.values():
+            files += [file for _, file in segments]
+        return list(dict.fromkeys(files))
+
+    def describe(self):
+        lines = ['0x{:08x}  {}'.format(offset, os.path.basename(file)) for offset, file in self.segments]
+        for chip, segments in self.chips.items():
+            lines += ['0x{:08x}  {} ({})'.format(offset, os.path.basename(file), chip) for offset, file in segments]
+        return '\n'.join(lines)
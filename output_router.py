@@ -0,0 +1,52 @@
+import contextvars
+import sys
+import threading
+from contextlib import contextmanager
+
+# esptool and the flash code print(); the router is installed as sys.stdout
+# once and sends every write to the sink of the context it comes from, so each
+# device session (thread) has its own log and nothing swaps sys.stdout per call
+
+_sink = contextvars.ContextVar('output_sink', default=None)
+_install_lock = threading.Lock()
+
+
+class OutputRouter:
+    def __init__(self, default):
+        # where writes outside any output_to() go (console, stderr)
+        self.default = default
+
+    def write(self, string):
+        (_sink.get() or self.default).write(string)
+
+    def flush(self):
+        (_sink.get() or self.default).flush()
+
+    def isatty(self):
+        return True
+
+
+def install():
+    with _install_lock:
+        if not isinstance(sys.stdout, OutputRouter):
+            sys.stdout = OutputRouter(sys.stdout)
+        return sys.stdout
+
+
+def set_default_output(stream):
+    # -> the previous default, for restoring it
+    router = install()
+    previous, router.default = router.default, stream
+    return previous
+
+
+@contextmanager
+def output_to(sink):
+    # everything printed in this context (thread, task) goes to sink; other
+    # threads start with their own context and are not affected
+    install()
+    token = _sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _sink.reset(token)
@@ -0,0 +1,180 @@
+import os
+import sys
+import threading
+import time
+from serial.tools import list_ports
+if sys.platform.startswith('linux'):
+    from serial.tools.list_ports_linux import SysFS
+
+# /dev entries pyserial's Linux comports() looks at
+DEV_PREFIXES = ('ttyS', 'ttyUSB', 'ttyXRUSB', 'ttyACM', 'ttyAMA', 'rfcomm', 'ttyAP')
+
+
+def usb_identity(info):
+    # stays the same when a board is replugged into the same hub port
+    if info.vid is None:
+        return info.device
+    return '{:04x}:{:04x}:{}'.format(info.vid, info.pid, info.serial_number or info.location or info.device)
+
+
+class PortInfo:
+    def __init__(self, info, stamp=None):
+        self.device = info.device
+        self.description = info.description
+        self.vid = info.vid
+        self.pid = info.pid
+        self.serial_number = info.serial_number
+        self.location = info.location
+        self.identity = usb_identity(info)
+        # node ctime on Linux, (vid, pid, serial, location) elsewhere; a new
+        # stamp under the same name is a different board
+        self.stamp = stamp if stamp is not None else (self.vid, self.pid, self.serial_number, self.location)
+        self.chip = None
+        self.mac = None
+        self.attached = time.time()
+
+    def __repr__(self):
+        return '<PortInfo {} {}>'.format(self.device, self.identity)
+
+
+class PortIndex:
+    # ports by device name, with lookups by USB identity; chip/MAC seen on a
+    # bridge outlive the port so a replugged board is recognised
+    def __init__(self):
+        self._ports = {}
+        self._by_identity = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def stamps(self):
+        with self._lock:
+            return {device: port.stamp for device, port in self._ports.items()}
+
+    def update(self, added, removed):
+        with self._lock:
+            for device in removed:
+                port = self._ports.pop(device, None)
+                if port is not None:
+                    self._by_identity.pop(port.identity, None)
+            for port in added:
+                port.chip, port.mac = self._seen.get(port.identity, (None, None))
+                self._ports[port.device] = port
+                self._by_identity[port.identity] = port
+
+    def remember(self, device, chip=None, mac=None):
+        with self._lock:
+            port = self._ports.get(device)
+            if port is None:
+                return
+            port.chip = chip or port.chip
+            port.mac = mac or port.mac
+            self._seen[port.identity] = (port.chip, port.mac)
+
+    def get(self, device):
+        with self._lock:
+            return self._ports.get(device)
+
+    def by_identity(self, identity):
+        with self._lock:
+            return self._by_identity.get(identity)
+
+    def devices(self):
+        with self._lock:
+            return sorted(self._ports)
+
+
+class PortWatcher(threading.Thread):
+    # rescans every interval and reports the difference to the last scan;
+    # ports present at start-up are indexed without attach events
+    def __init__(self, on_attach=None, on_detach=None, interval=0.5):
+        threading.Thread.__init__(self, name='port-watcher')
+        self.daemon = True
+        self.index = PortIndex()
+        self.on_attach = on_attach
+        self.on_detach = on_detach
+        self.interval = interval
+        self.last_scan_time = 0.0
+        # Linux nodes that aren't real ports (absent ttyS*), not looked up again
+        self._ignored = {}
+        # the watcher thread and Reload (GUI thread) both scan, one at a time,
+        # so no two scans report the same difference
+        self._scan_lock = threading.Lock()
+        self._done = threading.Event()
+        self.scan(notify=False)
+
+    def _scan_linux(self, known):
+        # listdir + stat per node; only new nodes are looked up in sysfs
+        current = {}
+        for name in os.listdir('/dev'):
+            if name.startswith(DEV_PREFIXES):
+                device = '/dev/' + name
+                try:
+                    current[device] = os.stat(device).st_ctime_ns
+                except OSError:
+                    pass
+        added = []
+        for device, stamp in current.items():
+            if known.get(device) != stamp and self._ignored.get(device) != stamp:
+                info = SysFS(device)
+                if info.subsystem == 'platform':
+                    self._ignored[device] = stamp
+                else:
+                    added.append(PortInfo(info, stamp))
+        removed = [device for device in known if known[device] != current.get(device)]
+        return added, removed
+
+    def _scan_comports(self, known):
+        current = {}
+        for info in list_ports.comports():
+            current[info.device] = PortInfo(info)
+        added = [port for device, port in current.items() if known.get(device) != port.stamp]
+        removed = [device for device in known if device not in current or known[device] != current[device].stamp]
+        return added, removed
+
+    def scan(self, notify=True):
+        with self._scan_lock:
+            start = time.perf_counter()
+            known = self.index.stamps()
+            if sys.platform.startswith('linux'):
+                added, removed = self._scan_linux(known)
+            else:
+                added, removed = self._scan_comports(known)
+            # a replaced port is detached first, then attached again
+            detached = [self.index.get(device) for device in removed]
+            self.index.update(added, removed)
+            self.last_scan_time = time.perf_counter() - start
+        if notify:
+            for port in detached:
+                if self.on_detach is not None:
+                    self.on_detach(port)
+            for port in added:
+                if self.on_attach is not None:
+                    self.on_attach(port)
+        return added, detached
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            try:
+                self.scan()
+            except Exception as e:
+                print('Port scan failed: {}'.format(e))
+
+    def stop(self, timeout=None):
+        self._done.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+def benchmark(scans=200):
+    watcher = PortWatcher()
+    times = []
+    for _ in range(scans):
+        watcher.scan()
+        times.append(watcher.last_scan_time)
+    times.sort()
+    print('{} ports, scan median {:.2f} ms, max {:.2f} ms'.format(
+        len(watcher.index.devices()), times[len(times) // 2] * 1e3, times[-1] * 1e3))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,201 @@
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from checkpoint import RESUME_CHUNK_SIZE
+from firmware_cache import BOOTLOADER_OFFSETS, firmware_cache
+from manifest import Manifest
+from timing import station_timings
+from unit_history import WARNING_PREFIX
+from lazy import LazyModule
+
+esptool = LazyModule('esptool')
+
+# work for the next board, done while the operator is still swapping boards:
+# as soon as a firmware or a port is picked, the image headers are checked,
+# the images are patched, hashed and compressed, esptool (and its stub
+# loaders) is loaded and the port is opened; Upload then only has to sync
+# the chip. Both show up in the station timing report ('prestage',
+# 'port_open'), the 'prepare' and 'connect' phases of the sessions shrink.
+
+ESP_IMAGE_MAGIC = 0xE9
+MAX_IMAGE_SEGMENTS = 16
+# deflate block size of every flasher stub
+STUB_WRITE_SIZE = 0x4000
+
+
+def check_image(address, data):
+    # -> what is wrong with the image header, None if it looks right; only
+    # what is written at a bootloader offset has to be an executable image
+    if address not in BOOTLOADER_OFFSETS and (not data or data[0] != ESP_IMAGE_MAGIC):
+        return None
+    if address == 0x0 and len(data) > 0x1000 and data[0] == 0xFF and data[0x1000] == ESP_IMAGE_MAGIC:
+        # a merged image for a chip with its bootloader at 0x1000
+        data = data[0x1000:]
+    if len(data) < 8:
+        return 'too short for an image header ({} bytes)'.format(len(data))
+    magic, segments, flash_mode, _ = struct.unpack('BBBB', data[:4])
+    if magic != ESP_IMAGE_MAGIC:
+        return 'no image header (magic 0x{:02x}, not 0x{:02x})'.format(magic, ESP_IMAGE_MAGIC)
+    if not 0 < segments <= MAX_IMAGE_SEGMENTS:
+        return 'bad image header ({} segments)'.format(segments)
+    if flash_mode > 3:
+        return 'bad image header (flash mode {})'.format(flash_mode)
+    return None
+
+
+class Prestage:
+    # one background thread for firmware, one for ports; a session that
+    # starts before the work is done waits for it instead of doing it again
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prestage')
+        self._ports = {}
+        self._lock = threading.Lock()
+
+    def stage_firmware(self, config, on_done=None):
+        # -> future of the warnings; on_done(warnings) runs on the prestage thread
+        return self._executor.submit(self._stage_firmware, config.firmware_path, config.mode,
+                                     config.diff_flash == "Yes", config.resume == "Yes", on_done)
+
+    def _stage_firmware(self, firmware_path, mode, diff, resume, on_done):
+        start = time.perf_counter()
+        warnings = []
+        try:
+            esptool.ESPLoader  # importing esptool decodes the stub loaders
+            manifest = Manifest.load(firmware_path)
+            segments = list(manifest.segments)
+            for variant in manifest.chips.values():
+                segments += [segment for segment in variant if segment not in segments]
+            for address, file in segments:
+                problem = check_image(address, firmware_cache.get(file).data)
+                if problem:
+                    warnings.append('{} at 0x{:x}: {}'.format(file, address, problem))
+            # what goes to a bootloader offset depends on the chip and flash
+            # size, it is prepared for those flashed lately; the rest fits any board
+            prepared = [firmware_cache.get(file).prepared_for(None, address, mode, None)
+                        for address, file in segments if address not in BOOTLOADER_OFFSETS]
+            for chip, flash_size in firmware_cache.targets():
+                prepared += [firmware_cache.get(file).prepared_for(chip, address, mode, flash_size)
+                             for address, file in manifest.segments_for(chip.CHIP_NAME)
+                             if address in BOOTLOADER_OFFSETS]
+            for image in prepared:
+                self._warm(image, diff, resume)
+        except Exception as e:
+            warnings.append('Prestaging {} failed: {}'.format(firmware_path, e))
+        station_timings.record('', 'prestage', time.perf_counter() - start)
+        for warning in warnings:
+            print(WARNING_PREFIX + warning)
+        if on_done is not None:
+            on_done(warnings)
+        return warnings
+
+    @staticmethod
+    def _warm(image, diff, resume):
+        # the pieces FlashSession.write_image will send, compressed and split into blocks
+        from flash_session import DIFF_CHUNK_SIZE
+        if diff:
+            pieces = [chunk for _, chunk in image.chunks(DIFF_CHUNK_SIZE)]
+        elif resume and image.trimmed().size > RESUME_CHUNK_SIZE:
+            pieces = [chunk for _, chunk in image.trimmed().chunks(RESUME_CHUNK_SIZE)]
+        else:
+            pieces = [image.trimmed()]
+        for piece in pieces:
+            piece.blocks(STUB_WRITE_SIZE)
+
+    def open_port(self, port):
+        # opened with DTR/RTS released, the board keeps running until the session resets it
+        with self._lock:
+            if port not in self._ports:
+                self._ports[port] = self._executor.submit(self._open, port)
+
+    @staticmethod
+    def _open(port):
+        start = time.perf_counter()
+        ser = serial.serial_for_url(port, do_not_open=True)
+        ser.baudrate = esptool.ESPLoader.ESP_ROM_BAUD
+        ser.dtr = False
+        ser.rts = False
+        ser.open()
+        station_timings.record(port, 'port_open', time.perf_counter() - start)
+        return ser
+
+    def take_port(self, port):
+        # the port opened ahead for a session, None if there is none (or it
+        # went away meanwhile), the caller then opens it by name
+        with self._lock:
+            future = self._ports.pop(port, None)
+        if future is None:
+            return None
+        ser = None
+        try:
+            ser = future.result()
+            # fails on the handle of a board that was unplugged since
+            ser.reset_input_buffer()
+            return ser
+        except Exception as e:
+            print('Prestaged port {} not usable ({}), opening it again'.format(port, e))
+            if ser is not None:
+                ser.close()
+            return None
+
+    def release_port(self, port=None):
+        # before something else opens the port by name; None releases all
+        with self._lock:
+            ports = list(self._ports) if port is None else [port]
+            futures = [self._ports.pop(p) for p in ports if p in self._ports]
+        for future in futures:
+            try:
+                future.result().close()
+            except Exception:
+                pass
+
+
+prestage = Prestage()
+
+
+def measure(size_kb=1024):
+    # one simulated board flashed cold and one after prestaging a new
+    # firmware, with the station timing report of both
+    import os
+    import tempfile
+    from argparse import Namespace
+    from fake_esp import FakeEsp
+    from flash_session import FlashSession
+    from flasher import DEVNULL
+    from output_router import output_to
+
+    config = Namespace(mode='dio', diff_flash='No', resume='Yes')
+    paths = []
+    for _ in range(2):
+        # an app image header (one segment, dio), half noise, half zeros
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+            f.write(bytes([ESP_IMAGE_MAGIC, 1, 2, 0x20]) + os.urandom(size_kb * 512) + bytes(size_kb * 512 - 4))
+            paths.append(f.name)
+    results = []
+    try:
+        for staged, path in zip([False, True], paths):
+            device = FakeEsp().start()
+            try:
+                if staged:
+                    config.firmware_path = path
+                    prestage.open_port(device.port)
+                    prestage.stage_firmware(config).result()
+                session = FlashSession(device.port, baud=921600, before='no_reset', after='no_reset')
+                with output_to(DEVNULL):
+                    session.flash(path)
+                results.append(('prestaged' if staged else 'cold', session.timings))
+            finally:
+                device.stop()
+    finally:
+        firmware_cache.clear()
+        for path in paths:
+            os.remove(path)
+    for name, timings in results:
+        print('{:<10} connect {:.3f} s, prepare {:.3f} s, total {:.3f} s'.format(
+            name, timings.get('connect', 0.0), timings.get('prepare', 0.0), sum(timings.values())))
+    print(station_timings.report())
+
+
+if __name__ == '__main__':
+    measure()
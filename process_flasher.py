@@ -0,0 +1,271 @@
+import atexit
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+from baud_tuner import baud_memory
+from checkpoint import checkpoints
+from flasher import Espflasher, VerifyError
+from firmware_cache import firmware_cache
+from manifest import Manifest
+from prestage import prestage
+from timing import station_timings
+from unit_history import unit_history
+
+# process backend for gang flashing: every port is flashed by its own worker
+# process, so compression, SLIP framing and output of one port don't hold the
+# GIL for the others. Firmware files are shared through shared memory, the
+# worker sends its output, progress and result back over its pipe. Workers
+# are kept and reused, start-up and image compression are paid once per process.
+#
+# A job is (config, port, {file: (shared memory name, size)}, {store: path}), None stops the worker.
+# Messages from the worker:
+#   ('log', text)
+#   ('warning', text)                reflash / duplicate MAC warning of the board
+#   ('progress', port, phase, done, total, seconds since the phase started)
+#   ('call', store, method, args)    baud memory / checkpoint update, applied by the parent
+#   ('ask', store, method, args)     run by the parent, which sends the return value back
+#   ('done', mac, verify, verify_ms, timings)
+#   ('error', message, verify error?, mac, verify, verify_ms, timings)
+
+# spawn everywhere: forking a process that runs wx or other threads isn't safe
+_context = multiprocessing.get_context('spawn')
+
+# stores a worker updates; its own copies are read-only, the parent's persist
+STORES = {'baud_memory': baud_memory, 'checkpoints': checkpoints, 'unit_history': unit_history}
+FORWARDED = {'baud_memory': ['record_success', 'record_failure'], 'checkpoints': ['start', 'confirm', 'clear'],
+             'unit_history': ['release']}
+# asked of the parent only: the boards in flight on other ports (in other
+# workers) are known to the parent alone
+ASKED = {'unit_history': ['check']}
+
+
+class SharedFirmware:
+    # firmware files copied once into shared memory, attached by every worker
+    def __init__(self):
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        # -> (shared memory name, size), a new block if the file changed
+        path = os.path.abspath(path)
+        image = firmware_cache.get(path)
+        with self._lock:
+            entry = self._blocks.get(path)
+            if entry is not None and entry[0] is image:
+                return entry[1].name, image.size
+            block = shared_memory.SharedMemory(create=True, size=max(1, image.size))
+            block.buf[:image.size] = image.data
+            if entry is not None:
+                self._release(entry[1])
+            self._blocks[path] = (image, block)
+            return block.name, image.size
+
+    @staticmethod
+    def _release(block):
+        block.close()
+        block.unlink()
+
+    def clear(self):
+        with self._lock:
+            for _, block in self._blocks.values():
+                self._release(block)
+            self._blocks.clear()
+
+
+shared_firmware = SharedFirmware()
+atexit.register(shared_firmware.clear)
+
+
+class FlashedBoard:
+    # what GangFlasher reads from a finished FlashSession
+    def __init__(self, port, mac, verify, verify_ms):
+        self.port = port
+        self.mac = mac
+        self.verify = verify
+        self._verify_ms = verify_ms
+
+    def verify_ms(self):
+        return self._verify_ms
+
+
+class FlashWorker:
+    # one worker process, flashes one port at a time
+    def __init__(self):
+        self.conn, child_conn = _context.Pipe()
+        self.process = _context.Process(target=_worker, args=(child_conn,), name='flash-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+        self.process.join(1)
+
+
+class WorkerPool:
+    # idle workers, a new one is started when none is free
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.process.is_alive():
+                    return worker
+        return FlashWorker()
+
+    def release(self, worker):
+        with self._lock:
+            self._idle.append(worker)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+
+worker_pool = WorkerPool()
+atexit.register(worker_pool.close)
+
+
+def flash_port_in_process(config, port, progress=None, on_warning=None):
+    # same interface as gang_flasher.flash_port; the worker's output is
+    # printed here, so it ends up in the calling thread's PortLog
+    shared = {file: shared_firmware.get(file) for file in Manifest.load(config.firmware_path).files()}
+    # the worker opens the port by name, a handle held here would lock it out on Windows
+    prestage.release_port(port)
+    worker = worker_pool.acquire()
+    finished = False
+    try:
+        worker.conn.send((config, port, shared,
+                          {name: store.path for name, store in STORES.items() if name not in ASKED}))
+        while True:
+            try:
+                message = worker.conn.recv()
+            except EOFError:
+                worker.process.join()
+                raise Espflasher("Flash process for {} exited with code {}".format(port, worker.process.exitcode))
+            kind = message[0]
+            if kind == 'log':
+                sys.stdout.write(message[1])
+            elif kind == 'progress':
+                if progress is not None:
+                    port_name, phase, done, total, elapsed = message[1:]
+                    progress.post(port_name, phase, done, total, time.perf_counter() - elapsed)
+            elif kind == 'warning':
+                if on_warning is not None:
+                    on_warning(message[1])
+            elif kind == 'call':
+                store, method, args = message[1:]
+                getattr(STORES[store], method)(*args)
+            elif kind == 'ask':
+                store, method, args = message[1:]
+                worker.conn.send(getattr(STORES[store], method)(*args))
+            elif kind == 'done':
+                finished = True
+                mac, verify, verify_ms, timings = message[1:]
+                station_timings.add_device(port, timings, True)
+                return FlashedBoard(port, mac, verify, verify_ms)
+            elif kind == 'error':
+                finished = True
+                error, is_verify, mac, verify, verify_ms, timings = message[1:]
+                station_timings.add_device(port, timings, False)
+                if is_verify:
+                    raise VerifyError(error, mac, verify, verify_ms)
+                raise Espflasher(error)
+    finally:
+        if finished:
+            worker_pool.release(worker)
+        else:
+            worker.stop()
+
+
+class PipeOutput:
+    # sys.stdout of a worker
+    def __init__(self, conn):
+        self._conn = conn
+
+    def write(self, string):
+        if string:
+            self._conn.send(('log', string))
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return True
+
+
+class PipeProgress:
+    # ProgressChannel of a worker, the parent posts into the real one
+    def __init__(self, conn):
+        self._conn = conn
+
+    def post(self, port, phase, done, total, started):
+        self._conn.send(('progress', port, phase, done, total, time.perf_counter() - started))
+
+
+def _forward(conn, name, store):
+    for method in FORWARDED[name]:
+        def forwarded(*args, _local=getattr(store, method), _method=method):
+            _local(*args)
+            conn.send(('call', name, _method, args))
+        setattr(store, method, forwarded)
+    for method in ASKED.get(name, []):
+        def asked(*args, _method=method):
+            # the parent answers before it reads anything else from this worker
+            conn.send(('ask', name, _method, args))
+            return conn.recv()
+        setattr(store, method, asked)
+
+
+def _worker(conn):
+    # main loop of a worker process
+    from flash_session import FlashSession
+    sys.stdout = PipeOutput(conn)
+    for name, store in STORES.items():
+        _forward(conn, name, store)
+    blocks = {}
+    try:
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                return
+            if job is None:
+                return
+            config, port, shared, store_paths = job
+            # the parent's stores as of now, other workers may have updated them
+            for name, path in store_paths.items():
+                if path is not None:
+                    STORES[name].open(path)
+                    STORES[name].path = None
+            for path, (block_name, size) in shared.items():
+                if block_name not in blocks:
+                    blocks[block_name] = shared_memory.SharedMemory(name=block_name)
+                    firmware_cache.share(path, blocks[block_name].buf[:size])
+            session = FlashSession.from_config(config, port, progress=PipeProgress(conn),
+                                               on_warning=lambda warning: conn.send(('warning', warning)))
+            try:
+                session.flash(config.firmware_path)
+                conn.send(('done', session.mac, session.verify, session.verify_ms(), session.timings))
+            except (Exception, SystemExit) as e:
+                is_verify = isinstance(e, VerifyError)
+                conn.send(('error', str(e), is_verify, session.mac, session.verify,
+                           e.verify_ms if is_verify else None, session.timings))
+    finally:
+        sys.stdout = sys.__stdout__
+        # the views into the blocks have to go before the blocks are closed
+        firmware_cache.clear()
+        for block in blocks.values():
+            block.close()
+        conn.close()
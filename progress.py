@@ -0,0 +1,44 @@
+import time
+from collections import deque, namedtuple
+
+# done/total are bytes for 'write', rate is bytes/s and eta seconds
+ProgressEvent = namedtuple('ProgressEvent', ['port', 'phase', 'done', 'total', 'rate', 'eta'])
+
+
+class ProgressChannel:
+    # worker threads post, the GUI thread drains on a timer; deque append and
+    # popleft are atomic so neither side takes a lock
+    def __init__(self, maxlen=10000):
+        self._events = deque(maxlen=maxlen)
+
+    def post(self, port, phase, done, total, started):
+        elapsed = time.perf_counter() - started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else None
+        self._events.append(ProgressEvent(port, phase, done, total, rate, eta))
+
+    def drain(self):
+        # latest event of every port, older ones are already stale
+        latest = {}
+        while True:
+            try:
+                event = self._events.popleft()
+            except IndexError:
+                break
+            latest[event.port] = event
+        return list(latest.values())
+
+
+def percent(event):
+    if not event.total:
+        return 0
+    return min(100, 100 * event.done // event.total)
+
+
+def describe(event):
+    text = '{} {} %'.format(event.phase.capitalize(), percent(event))
+    if event.phase == 'write' and event.rate:
+        text += ', {:.1f} kB/s'.format(event.rate / 1000)
+        if event.eta is not None:
+            text += ', {:.0f} s left'.format(event.eta)
+    return text
@@ -0,0 +1,229 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+HEADINGS = ['Sl-No', 'MAC-ID', 'Date', 'File Name', 'Verify', 'Verify ms']
+
+
+def get_store_path(xlsx_path):
+    # where earlier versions kept the record log, next to the workbook
+    return os.path.splitext(xlsx_path)[0] + '.db'
+
+
+class RecordStore:
+    # append-only log of flashed boards; SQLite in WAL mode so every record is
+    # one small committed insert, the workbook is only an export of it
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS records ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'sl_no INTEGER, mac TEXT, date TEXT, file_name TEXT)')
+        # verify mode and time of the board, added after the first release
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(records)')]
+        if 'verify' not in columns:
+            self._db.execute('ALTER TABLE records ADD COLUMN verify TEXT')
+            self._db.execute('ALTER TABLE records ADD COLUMN verify_ms INTEGER')
+        self._db.execute('CREATE INDEX IF NOT EXISTS records_sl_no ON records (sl_no)')
+        # history lookups: was this MAC flashed before, what went out on a day, with a file
+        self._db.execute('CREATE INDEX IF NOT EXISTS records_mac ON records (mac, id)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS records_date ON records (date, id)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS records_file_name ON records (file_name, id)')
+        # boards that failed verification, they get no Sl-No
+        self._db.execute('CREATE TABLE IF NOT EXISTS failures ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'mac TEXT, date TEXT, file_name TEXT, verify TEXT, verify_ms INTEGER, error TEXT)')
+        # boards identified by the harvest mode, not flashed and without Sl-No
+        self._db.execute('CREATE TABLE IF NOT EXISTS inspections ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'mac TEXT, date TEXT, port TEXT, chip TEXT, revision INTEGER, flash_size TEXT, '
+                         'crystal_mhz INTEGER, error TEXT)')
+        # last Sl-No handed out, bumped in the same transaction as the insert
+        self._db.execute('CREATE TABLE IF NOT EXISTS sequence (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self.seed(0)
+
+    @classmethod
+    def open(cls, path):
+        # one connection per file and process
+        path = os.path.abspath(path)
+        with cls._stores_lock:
+            if path not in cls._stores:
+                cls._stores[path] = cls(path)
+            return cls._stores[path]
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so threads (same connection)
+        # and other processes/stations (same file) are serialised; a crash
+        # before COMMIT leaves neither the record nor the Sl-No behind
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def seed(self, last_sl_no):
+        # never moves backwards, whatever the records or the legacy row counter say
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO sequence (name, value) VALUES ('sl_no', 0)")
+            db.execute("UPDATE sequence SET value = MAX(value, ?, (SELECT IFNULL(MAX(sl_no), 0) FROM records)) "
+                       "WHERE name = 'sl_no'", (int(last_sl_no),))
+
+    def append(self, mac_id, day, file_name, verify=None, verify_ms=None):
+        # allocates the next Sl-No and stores the record atomically, returns the Sl-No
+        with self._transaction() as db:
+            db.execute("UPDATE sequence SET value = value + 1 WHERE name = 'sl_no'")
+            sl_no = db.execute("SELECT value FROM sequence WHERE name = 'sl_no'").fetchone()[0]
+            db.execute('INSERT INTO records (sl_no, mac, date, file_name, verify, verify_ms) VALUES (?, ?, ?, ?, ?, ?)',
+                       (sl_no, mac_id, day, file_name, verify, verify_ms))
+        return sl_no
+
+    def append_batch(self, records):
+        # (mac, date, file_name[, verify, verify_ms]) records in one transaction
+        # with consecutive Sl-Nos
+        with self._transaction() as db:
+            db.execute("UPDATE sequence SET value = value + ? WHERE name = 'sl_no'", (len(records),))
+            last = db.execute("SELECT value FROM sequence WHERE name = 'sl_no'").fetchone()[0]
+            sl_nos = list(range(last - len(records) + 1, last + 1))
+            db.executemany('INSERT INTO records (sl_no, mac, date, file_name, verify, verify_ms) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           [((sl_no,) + tuple(record) + (None, None))[:6] for sl_no, record in zip(sl_nos, records)])
+        return sl_nos
+
+    def append_failure(self, mac_id, day, file_name, verify, verify_ms, error):
+        with self._transaction() as db:
+            db.execute('INSERT INTO failures (mac, date, file_name, verify, verify_ms, error) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', (mac_id, day, file_name, verify, verify_ms, error))
+
+    def failures(self):
+        with self._lock:
+            return self._db.execute('SELECT mac, date, file_name, verify, verify_ms, error FROM failures '
+                                    'ORDER BY id').fetchall()
+
+    def append_inspection(self, day, port, mac=None, chip=None, revision=None, flash_size=None, crystal_mhz=None,
+                          error=None):
+        with self._transaction() as db:
+            db.execute('INSERT INTO inspections (mac, date, port, chip, revision, flash_size, crystal_mhz, error) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (mac, day, port, chip, revision, flash_size, crystal_mhz, error))
+
+    def inspections(self):
+        with self._lock:
+            return self._db.execute('SELECT mac, date, port, chip, revision, flash_size, crystal_mhz, error '
+                                    'FROM inspections ORDER BY id').fetchall()
+
+    def append_many(self, rows):
+        # (sl_no, mac, date, file_name[, verify, verify_ms]) rows that already have their number
+        with self._transaction() as db:
+            db.executemany('INSERT INTO records (sl_no, mac, date, file_name, verify, verify_ms) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', ((tuple(row) + (None, None))[:6] for row in rows))
+        self.seed(0)
+
+    def empty(self):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM records LIMIT 1').fetchone() is None
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def find(self, mac=None, day=None, file_name=None, limit=None):
+        # (sl_no, mac, date, file_name, verify, verify_ms) matching all given
+        # keys, newest first; every key is indexed
+        where = [(column, value) for column, value in (('mac', mac), ('date', day), ('file_name', file_name))
+                 if value is not None]
+        sql = 'SELECT sl_no, mac, date, file_name, verify, verify_ms FROM records'
+        if where:
+            # only the most selective key (MAC, then date, then file) is looked up
+            # in its index; without statistics SQLite may pick the file index
+            sql += ' WHERE ' + ' AND '.join('{}{} = ?'.format('+' if i else '', column)
+                                            for i, (column, _) in enumerate(where))
+        sql += ' ORDER BY id DESC'
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self._lock:
+            return self._db.execute(sql, [value for _, value in where]).fetchall()
+
+    def rows(self, after_id=0, chunk=1000):
+        # (id, sl_no, mac, date, file_name, verify, verify_ms) in insert order, fetched in chunks
+        while True:
+            with self._lock:
+                chunk_rows = self._db.execute('SELECT id, sl_no, mac, date, file_name, verify, verify_ms FROM records '
+                                              'WHERE id > ? ORDER BY id LIMIT ?', (after_id, chunk)).fetchall()
+            if not chunk_rows:
+                return
+            for row in chunk_rows:
+                yield row
+            after_id = chunk_rows[-1][0]
+
+    def close(self):
+        with self._stores_lock:
+            self._stores.pop(os.path.abspath(self.path), None)
+        with self._lock:
+            self._db.close()
+
+
+def benchmark(count=100000, path='benchmark-records.db'):
+    # per-record cost must stay flat as the log grows
+    if os.path.exists(path):
+        os.remove(path)
+    store = RecordStore(path)
+    step = count // 10
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        store.append('24:0a:c4:%02x:%02x:%02x' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), '2024-01-01', 'fw.bin')
+        if i % step == 0:
+            now = time.perf_counter()
+            print('{:>7} records: {:.1f} us/record'.format(i, (now - start) / step * 1e6))
+            start = now
+    store.close()
+    remove_store(path)
+
+
+def lookup_benchmark(count=1000000, lookups=10000, path='benchmark-history.db'):
+    # MAC / date / file lookups against a history of count records
+    remove_store(path)
+    store = RecordStore(path)
+    start = time.perf_counter()
+    step = 10000
+    for first in range(0, count, step):
+        store.append_batch([('24:0a:c4:%02x:%02x:%02x' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+                             '2024-%02d-%02d' % (i // 100000 % 12 + 1, i // 10000 % 28 + 1), 'fw-%d.bin' % (i % 50))
+                            for i in range(first, min(count, first + step))])
+    print('{} records inserted in {:.1f} s'.format(count, time.perf_counter() - start))
+    for name, query in [('mac', lambda i: store.find(mac='24:0a:c4:%02x:%02x:%02x' % (i >> 16 & 0xff, i >> 8 & 0xff,
+                                                                                    i & 0xff))),
+                        ('mac+file', lambda i: store.find(mac='24:0a:c4:00:00:%02x' % (i & 0xff),
+                                                          file_name='fw-%d.bin' % (i % 50))),
+                        ('date, last 10', lambda i: store.find(day='2024-%02d-01' % (i % 12 + 1), limit=10)),
+                        ('unknown mac', lambda i: store.find(mac='aa:bb:cc:dd:ee:%02x' % (i & 0xff)))]:
+        start = time.perf_counter()
+        for i in range(lookups):
+            query(i * 7919 % count)
+        print('{:<14}{:>8.1f} us/lookup'.format(name, (time.perf_counter() - start) / lookups * 1e6))
+    store.close()
+    remove_store(path)
+
+
+def remove_store(path):
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['lookup']:
+        sys.exit(lookup_benchmark())
+    benchmark()
@@ -0,0 +1,57 @@
+import queue
+import threading
+import time
+
+
+class RecordWriter(threading.Thread):
+    # persistence worker: flash workers / the GUI put finished records, they are
+    # written in batches when enough are waiting or the oldest got too old
+    def __init__(self, save_batch, on_saved=None, batch_size=20, max_delay=0.5):
+        threading.Thread.__init__(self)
+        # to exit when main thread exits, stop() flushes what is left
+        self.daemon = True
+        self._save_batch = save_batch
+        self._on_saved = on_saved or (lambda saved, failed: None)
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._queue = queue.Queue()
+        self._done = object()
+
+    def put(self, mac_id, file_name, verify=None, verify_ms=None):
+        self._queue.put((mac_id, file_name, verify, verify_ms))
+
+    def stop(self, timeout=10):
+        self._queue.put(self._done)
+        self.join(timeout)
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self._done:
+                self._flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self._max_delay
+            if batch and (len(batch) >= self._batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        try:
+            sl_nos = self._save_batch(batch)
+        except Exception as e:
+            print("Saving {} records failed: {}".format(len(batch), e))
+            self._on_saved([], batch)
+            return
+        self._on_saved(list(zip(sl_nos, batch)), [])
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+import serial
+from concurrent.futures import ThreadPoolExecutor
+from flasher import Espflasher, VerifyError
+from flash_session import FlashSession
+from gang_flasher import PortLog
+from manifest import Manifest
+from output_router import output_to
+from timing import station_timings
+
+# stages every board goes through, in order; a board that fails any of them ends in FAILED
+STAGES = ['detect', 'identify', 'flash', 'verify', 'reset', 'persist', 'done']
+QUEUED = 'queued'
+FAILED = 'failed'
+
+
+class DeviceJob:
+    def __init__(self, port):
+        self.port = port
+        self.stage = QUEUED
+        self.chip = None
+        self.mac = None
+        self.sl_no = None
+        self.verify_ms = None
+        self.warnings = []
+        self.error = None
+        self.log = []
+        self.timings = {}
+        self.started = time.time()
+        self.finished = None
+
+    def __repr__(self):
+        return '<DeviceJob {} {} {}>'.format(self.port, self.stage, self.mac)
+
+
+class Station:
+    # no-click production mode: every board handed to add() (usually from the
+    # PortWatcher attach event) runs detect -> identify -> flash -> verify ->
+    # reset -> persist on its own worker, so boards overlap in different stages
+    def __init__(self, config, persist, max_workers=4, progress=None, on_update=None,
+                 session_factory=FlashSession.from_config, detect_timeout=10.0, persist_failure=None):
+        self._config = config
+        # persist(mac, file_name, verify, verify_ms) -> Sl-No and
+        # persist_failure(VerifyError, file_name), called from the worker thread
+        self._persist = persist
+        self._persist_failure = persist_failure
+        self._progress = progress
+        self._on_update = on_update or (lambda job: None)
+        self._session_factory = session_factory
+        self.detect_timeout = detect_timeout
+        self.jobs = []
+        self._active = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_workers)), thread_name_prefix="station")
+        self.opened = time.time()
+
+    def add(self, port):
+        # a port already on its way through the pipeline is not queued twice
+        with self._lock:
+            if port in self._active:
+                return None
+            job = DeviceJob(port)
+            self._active[port] = job
+            self.jobs.append(job)
+        self._on_update(job)
+        self._executor.submit(self._run, job)
+        return job
+
+    def _set_stage(self, job, stage):
+        job.stage = stage
+        self._on_update(job)
+
+    def _run(self, job):
+        with output_to(PortLog(job, self._on_update)):
+            self._run_logged(job)
+
+    def _run_logged(self, job):
+        session = self._session_factory(self._config, job.port, progress=self._progress)
+        firmware_path = self._config.firmware_path
+        steps = [
+            ('detect', lambda: self._detect(session)),
+            ('identify', lambda: self._identify(session, job)),
+            ('flash', lambda: self._flash(session, manifest)),
+            ('verify', lambda: session.verify_segments(manifest)),
+            ('reset', session.hard_reset),
+            ('persist', lambda: self._store(job, session, firmware_path)),
+        ]
+        try:
+            manifest = Manifest.load(firmware_path)
+            for stage, step in steps:
+                self._set_stage(job, stage)
+                start = time.perf_counter()
+                step()
+                job.timings[stage] = time.perf_counter() - start
+            print(session.timing_report())
+            job.stage = 'done'
+        except (Exception, SystemExit) as e:
+            print("Unexpected error: {}".format(e))
+            job.error = str(e)
+            job.stage = FAILED
+            if isinstance(e, VerifyError):
+                job.verify_ms = e.verify_ms
+                try:
+                    if self._persist_failure is not None:
+                        self._persist_failure(e, os.path.basename(firmware_path))
+                except Exception as store_error:
+                    print("Saving the verify failure failed: {}".format(store_error))
+        finally:
+            session.close()
+            timings = dict(session.timings)
+            if 'persist' in job.timings:
+                timings['persist'] = job.timings['persist']
+            station_timings.add_device(job.port, timings, job.stage == 'done')
+            job.finished = time.time()
+            with self._lock:
+                self._active.pop(job.port, None)
+        if self._progress is not None:
+            self._progress.post(job.port, job.stage, 1, 1, time.perf_counter())
+        self._on_update(job)
+
+    def _detect(self, session):
+        # a board that was just plugged in may still be enumerating or booting
+        deadline = time.perf_counter() + self.detect_timeout
+        while True:
+            try:
+                return session.connect()
+            except (Espflasher, serial.SerialException, OSError) as e:
+                session.close()
+                if time.perf_counter() > deadline:
+                    raise Espflasher("No chip detected on {}: {}".format(session.port, e))
+                time.sleep(0.5)
+
+    @staticmethod
+    def _identify(session, job):
+        job.mac = session.read_mac()
+        job.chip = session.esp.CHIP_NAME
+        # what unit_history.check found, shown next to the board
+        job.warnings = session.warnings
+
+    @staticmethod
+    def _flash(session, manifest):
+        session.begin(manifest)
+        session.write_segments(manifest)
+
+    def _store(self, job, session, firmware_path):
+        job.verify_ms = session.verify_ms()
+        job.sl_no = self._persist(job.mac, os.path.basename(firmware_path), session.verify, job.verify_ms)
+
+    def busy(self):
+        with self._lock:
+            return bool(self._active)
+
+    def summary(self):
+        done = sum(1 for job in self.jobs if job.stage == 'done')
+        failed = sum(1 for job in self.jobs if job.stage == FAILED)
+        hours = (time.time() - self.opened) / 3600
+        return "{} done, {} failed, {:.0f} units/h".format(done, failed, done / hours if hours else 0)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
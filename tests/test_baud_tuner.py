@@ -0,0 +1,25 @@
+import json
+from baud_tuner import BaudMemory
+
+
+def test_damaged_file_starts_empty(tmp_path):
+    path = tmp_path / 'baud.json'
+    path.write_text('{bad')
+    memory = BaudMemory()
+    memory.open(str(path))
+    assert memory.best('bridge') is None
+    # the next success replaces the damaged file with a complete one
+    memory.record_success('bridge', 921600, 80000)
+    assert json.loads(path.read_text()) == {'bridge': {'baud': 921600, 'rate': 80000, 'failures': 0}}
+    assert not (tmp_path / 'baud.json.tmp').exists()
+
+
+def test_rates_survive_reopening(tmp_path):
+    path = str(tmp_path / 'baud.json')
+    memory = BaudMemory()
+    memory.open(path)
+    memory.record_success('bridge', 921600, 80000)
+    memory.record_failure('bridge', 921600)
+    reopened = BaudMemory()
+    reopened.open(path)
+    assert reopened.best('bridge') == 460800
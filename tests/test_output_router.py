@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from output_router import output_to
+
+fake_esp = pytest.importorskip('fake_esp')  # POSIX only (pty)
+
+
+class LineLog:
+    # sink keeping whole lines, for checking what a session printed
+    def __init__(self):
+        self.lines = []
+        self._partial = ''
+
+    def write(self, string):
+        lines = (self._partial + string).split('\n')
+        self._partial = lines.pop()
+        self.lines.extend(lines)
+
+    def flush(self):
+        pass
+
+
+def test_concurrent_sessions_keep_their_own_logs(tmp_path):
+    # every log holds exactly its own board's output, complete and in order
+    from flash_session import FlashSession
+    sessions = 32
+    firmware = tmp_path / 'firmware.bin'
+    firmware.write_bytes(os.urandom(64 * 1024))
+    devices = [fake_esp.FakeEsp(seed=i).start() for i in range(sessions)]
+
+    def flash(device):
+        log = LineLog()
+        with output_to(log):
+            session = FlashSession(device.port, baud=921600, before='no_reset', after='no_reset')
+            session.flash(str(firmware))
+        return session.mac, log.lines
+
+    try:
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            results = list(executor.map(flash, devices))
+    finally:
+        for device in devices:
+            device.stop()
+    macs = [':'.join('{:02x}'.format(x) for x in device.mac) for device in devices]
+    for device, expected, (mac, lines) in zip(devices, macs, results):
+        assert mac == expected
+        # its own milestones once each and in order, nothing of another board
+        markers = ['MAC: ' + expected, 'Stub running...', 'Hash of data verified.', 'Leaving...',
+                   'Timing ({}, 921600 baud):'.format(device.port)]
+        assert [lines.count(marker) for marker in markers] == [1] * len(markers), device.port
+        found = [lines.index(marker) for marker in markers]
+        assert found == sorted(found), device.port
+        assert not [line for line in lines for other in macs if other != expected and other in line]
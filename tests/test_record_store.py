@@ -0,0 +1,32 @@
+import multiprocessing
+import threading
+from record_store import RecordStore
+
+
+def _append_from_threads(path, threads, count):
+    store = RecordStore(path)
+    workers = [threading.Thread(target=lambda: [store.append('mac', 'day', 'file') for _ in range(count)])
+               for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    store.close()
+
+
+def test_sl_no_unique_across_processes_and_threads(tmp_path):
+    # many processes with many threads each; Sl-No must come out as 1..N
+    processes, threads, count = 4, 8, 200
+    path = str(tmp_path / 'records.db')
+    RecordStore(path).close()
+    jobs = [multiprocessing.Process(target=_append_from_threads, args=(path, threads, count))
+            for _ in range(processes)]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    assert [job.exitcode for job in jobs] == [0] * processes
+    store = RecordStore(path)
+    numbers = sorted(row[1] for row in store.rows())
+    store.close()
+    assert numbers == list(range(1, processes * threads * count + 1))
@@ -0,0 +1,136 @@
+import os
+import time
+import pytest
+from config_file import FlashConfig
+from flash_session import DIFF_CHUNK_SIZE, FlashSession
+from record_store import RecordStore
+from station import FAILED, Station
+
+fake_esp = pytest.importorskip('fake_esp')  # POSIX only (pty)
+
+DAY = '2026-01-01'
+
+
+@pytest.fixture
+def firmware(tmp_path):
+    path = tmp_path / 'app.bin'
+    path.write_bytes(os.urandom(4 * DIFF_CHUNK_SIZE))
+    return path
+
+
+@pytest.fixture
+def config(firmware):
+    config = FlashConfig()
+    config.firmware_path = str(firmware)
+    config.baud = 921600
+    # a pty has no DTR/RTS
+    config.before = config.after = 'no_reset'
+    return config
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RecordStore(str(tmp_path / 'records.db'))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def boards():
+    started = []
+
+    def start(count=1, **kwargs):
+        started.extend(fake_esp.FakeEsp(**kwargs).start() for _ in range(count))
+        return started[-count:]
+    yield start
+    for board in started:
+        board.stop()
+
+
+def make_station(config, store, failures=None, **kwargs):
+    def persist(mac, file_name, verify, verify_ms):
+        return store.append(mac, DAY, file_name, verify, verify_ms)
+
+    def persist_failure(error, file_name):
+        failures.append((error, file_name))
+    return Station(config, persist, persist_failure=persist_failure, detect_timeout=2.0, **kwargs)
+
+
+def wait_idle(station, timeout=30.0):
+    deadline = time.time() + timeout
+    while station.busy():
+        assert time.time() < deadline, 'station did not finish'
+        time.sleep(0.01)
+
+
+def mac_of(board):
+    return ':'.join('{:02x}'.format(x) for x in board.mac)
+
+
+def log_of(job):
+    return ''.join(job.log)
+
+
+def test_boards_are_flashed_and_persisted(config, store, boards, firmware):
+    devices = boards(3)
+    station = make_station(config, store)
+    jobs = [station.add(device.port) for device in devices]
+    station.shutdown()
+    assert [job.stage for job in jobs] == ['done'] * 3, [job.error for job in jobs]
+    assert sorted(job.sl_no for job in jobs) == [1, 2, 3]
+    records = {record[1]: record for record in store.find(day=DAY)}
+    for device, job in zip(devices, jobs):
+        assert job.mac == mac_of(device)
+        sl_no, mac, day, file_name, verify, verify_ms = records[job.mac]
+        assert (sl_no, file_name, verify) == (job.sl_no, firmware.name, 'hash')
+        assert bytes(device.flash[:firmware.stat().st_size]) == firmware.read_bytes()
+
+
+def test_diff_rewrites_only_changed_chunks(config, store, boards, firmware):
+    config.diff_flash = 'Yes'
+    device, = boards()
+    image = firmware.read_bytes()
+    # the board already has the image except for its second chunk
+    device.flash[:len(image)] = image
+    device.flash[DIFF_CHUNK_SIZE:DIFF_CHUNK_SIZE + 16] = b'\x00' * 16
+    station = make_station(config, store)
+    first = station.add(device.port)
+    wait_idle(station)
+    second = station.add(device.port)
+    station.shutdown()
+    assert (first.stage, second.stage) == ('done', 'done')
+    assert 'Diff: 1 of 4 chunks differ' in log_of(first)
+    assert 'Flash already matches the image, nothing to write.' in log_of(second)
+    assert bytes(device.flash[:len(image)]) == image
+    assert [record[0] for record in store.find(mac=mac_of(device))] == [2, 1]
+
+
+def test_paranoid_verify_reads_sectors_back(config, store, boards):
+    config.verify = 'Paranoid'
+    device, = boards()
+    station = make_station(config, store)
+    job = station.add(device.port)
+    station.shutdown()
+    assert job.stage == 'done', job.error
+    assert 'Read back ' in log_of(job)
+    assert store.find(mac=job.mac)[0][4] == 'paranoid'
+
+
+def test_verify_failure_is_reported_and_not_persisted(config, store, boards, firmware):
+    device, = boards()
+
+    class CorruptingSession(FlashSession):
+        # the flash changes after it was written, as a failing chip would
+        def write_segments(self, manifest):
+            super().write_segments(manifest)
+            device.flash[0x100] ^= 0xff
+
+    failures = []
+    station = make_station(config, store, failures, session_factory=CorruptingSession.from_config)
+    job = station.add(device.port)
+    station.shutdown()
+    assert job.stage == FAILED
+    assert 'MD5 of file does not match data in flash' in job.error
+    assert store.find(mac=mac_of(device)) == []
+    (error, file_name), = failures
+    assert (error.mac, error.mode, file_name) == (mac_of(device), 'hash', firmware.name)
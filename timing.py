@@ -0,0 +1,119 @@
+import csv
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+# one timed phase of one device; port is '' for work not tied to a board (record saving)
+Span = namedtuple('Span', ['port', 'phase', 'end', 'seconds'])
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def quantile(values, q):
+    # nearest rank of already sorted values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Timings:
+    # spans of the last maxlen phases and finished boards, shared by all
+    # workers; aggregates are computed on demand from the bounded history
+    def __init__(self, maxlen=50000):
+        self._spans = deque(maxlen=maxlen)
+        self._units = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, port, phase, seconds):
+        with self._lock:
+            self._spans.append(Span(port, phase, time.time(), seconds))
+
+    @contextmanager
+    def span(self, port, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(port, phase, time.perf_counter() - start)
+
+    def add_device(self, port, timings, ok):
+        # phase -> seconds of one board, plus its total; counts towards units/hour
+        now = time.time()
+        with self._lock:
+            for phase, seconds in timings.items():
+                self._spans.append(Span(port, phase, now, seconds))
+            self._spans.append(Span(port, 'total', now, sum(timings.values())))
+            self._units.append((now, ok))
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._units.clear()
+            self.started = time.time()
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def stats(self):
+        # [(phase, count, mean, p50, p90, p99, max)] in first-seen order, total last
+        by_phase = {}
+        for span in self.spans():
+            by_phase.setdefault(span.phase, []).append(span.seconds)
+        by_phase['total'] = by_phase.pop('total', [])
+        rows = []
+        for phase, values in by_phase.items():
+            if not values:
+                continue
+            values.sort()
+            rows.append((phase, len(values), sum(values) / len(values))
+                        + tuple(quantile(values, q) for q in QUANTILES) + (values[-1],))
+        return rows
+
+    def units(self):
+        with self._lock:
+            passed = sum(1 for _, ok in self._units if ok)
+            return passed, len(self._units) - passed
+
+    def units_per_hour(self, window=3600):
+        # passed boards in the last window, scaled to an hour; at least a
+        # minute so the first boards aren't extrapolated
+        now = time.time()
+        with self._lock:
+            recent = sum(1 for end, ok in self._units if ok and end > now - window)
+        return recent * 3600 / max(60.0, min(window, now - self.started))
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(Span._fields)
+            writer.writerows(self.spans())
+
+    def to_prometheus(self):
+        # text exposition format, for a node_exporter textfile collector
+        lines = ['# TYPE espflasher_phase_seconds summary']
+        for phase, count, mean, *quantiles, _ in self.stats():
+            for q, value in zip(QUANTILES, quantiles):
+                lines.append('espflasher_phase_seconds{{phase="{}",quantile="{}"}} {:.6f}'.format(phase, q, value))
+            lines.append('espflasher_phase_seconds_sum{{phase="{}"}} {:.6f}'.format(phase, mean * count))
+            lines.append('espflasher_phase_seconds_count{{phase="{}"}} {}'.format(phase, count))
+        passed, failed = self.units()
+        lines.append('# TYPE espflasher_units_total counter')
+        lines.append('espflasher_units_total{{result="pass"}} {}'.format(passed))
+        lines.append('espflasher_units_total{{result="fail"}} {}'.format(failed))
+        lines.append('# TYPE espflasher_units_per_hour gauge')
+        lines.append('espflasher_units_per_hour {:.1f}'.format(self.units_per_hour()))
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        lines = ['{:<12}{:>7}{:>9}{:>9}{:>9}{:>9}{:>9}'.format('phase', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+        for phase, count, *values in self.stats():
+            lines.append('{:<12}{:>7}'.format(phase, count) + ''.join('{:>9.3f}'.format(v) for v in values))
+        passed, failed = self.units()
+        lines.append('{} passed, {} failed, {:.0f} units/h'.format(passed, failed, self.units_per_hour()))
+        return '\n'.join(lines)
+
+
+station_timings = Timings()
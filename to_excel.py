@@ -1,18 +1,140 @@
-import pylightxl as xl
+import csv
 import os.path
-from config_file import ExcelConfig
+import zipfile
+from itertools import islice
+from xml.sax.saxutils import escape
+from config_file import ExcelConfig, get_records_file_path
+from record_store import RecordStore, HEADINGS, get_store_path
 from datetime import date
+from flasher import VerifyError
+from lazy import LazyModule
+from timing import station_timings
+
+xl = LazyModule('pylightxl')
+
+# exports are written this many rows at a time, memory stays the same for any history size
+EXPORT_CHUNK = 1000
+
+SPREADSHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+DOCUMENT_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+# the parts of a one-sheet workbook besides the sheet itself
+XLSX_PARTS = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="' + RELATIONSHIPS_NS + '">'
+        '<Relationship Id="rId1" Type="' + DOCUMENT_NS + '/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="' + SPREADSHEET_NS + '" xmlns:r="' + DOCUMENT_NS + '">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="' + RELATIONSHIPS_NS + '">'
+        '<Relationship Id="rId1" Type="' + DOCUMENT_NS + '/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+
+def _xlsx_row(number, values):
+    # cells carry their A1 reference, readers like pylightxl rely on it
+    cells = []
+    for col, value in enumerate(values):
+        ref = '{}{}'.format(chr(ord('A') + col), number)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append('<c r="{}"><v>{}</v></c>'.format(ref, value))
+        elif value is not None:
+            cells.append('<c r="{}" t="str"><v>{}</v></c>'.format(ref, escape(str(value))))
+    return '<row r="{}">{}</row>'.format(number, ''.join(cells))
+
+
+def write_xlsx(path, headings, rows):
+    # the sheet is streamed into the zip chunk by chunk; strings are stored in
+    # the cells (t="str"), a shared string table would have to be held in memory
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, part in XLSX_PARTS.items():
+            workbook.writestr(name, part)
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                         '<worksheet xmlns="' + SPREADSHEET_NS + '"><sheetData>').encode())
+            count = 0
+            rows = iter(rows)
+            sheet.write(_xlsx_row(1, headings).encode())
+            while True:
+                chunk = list(islice(rows, EXPORT_CHUNK))
+                if not chunk:
+                    break
+                sheet.write(''.join(_xlsx_row(count + i + 2, row) for i, row in enumerate(chunk)).encode())
+                count += len(chunk)
+            sheet.write(b'</sheetData></worksheet>')
+    return count
+
+
+def write_csv(path, headings, rows):
+    count = 0
+    rows = iter(rows)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headings)
+        while True:
+            chunk = list(islice(rows, EXPORT_CHUNK))
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            count += len(chunk)
+    return count
 
 
 class Excel:
+    # where export() writes the workbook; the records themselves are in one
+    # store (store_path, the config dir by default) whatever the workbook path
     path = 'output.xlsx'
+    store_path = None
     saved_data = ''
 
     def __init__(self):
-        self.db = xl.Database()
         self.output_file = 'output.xlsx'
         self.date = str(date.today())
-        self._config = ExcelConfig.load()
+        self.store = self.open_store()
+
+    @staticmethod
+    def open_store():
+        path = Excel.store_path or get_records_file_path()
+        new_store = not os.path.isfile(path)
+        store = RecordStore.open(path)
+        if new_store:
+            if os.path.isfile(get_store_path(Excel.path)):
+                Excel.import_store(store, get_store_path(Excel.path))
+            elif os.path.isfile(Excel.path):
+                Excel.import_workbook(store, Excel.path)
+            # carry on from the old row counter of esp-flasher-gui-excel.json
+            store.seed(ExcelConfig.load().row_id - 2)
+        return store
+
+    @staticmethod
+    def import_store(store, path):
+        # one-off: the record log an earlier version kept next to the workbook
+        store.append_many(row[1:] for row in RecordStore.open(path).rows(chunk=EXPORT_CHUNK))
+        print(f'Imported {store.count()} records from {path}')
+
+    @staticmethod
+    def import_workbook(store, path):
+        # one-off: rows of a workbook written before the record store existed
+        db = xl.readxl(fn=path)
+        rows = [row[:4] for row in db.ws(ws='Sheet1').rows][1:]
+        store.append_many([tuple(row) + ('',) * (4 - len(row)) for row in rows])
+        print(f'Imported {len(rows)} rows from {path}')
 
     def set_output_path(self, path):
         Excel.path = path
@@ -23,34 +145,50 @@ class Excel:
             Excel.path += '/' + self.output_file
         print(Excel.path)
 
-    def save_data(self, mac_id, file_name):
-        # check for file or create
-        if os.path.isfile(Excel.path):
-            self.db = xl.readxl(fn='output.xlsx')
-            self.db.ws(ws="Sheet1")
-        else:
-            # add a blank worksheet to the db
-            self.db.add_ws(ws="Sheet1")
-            self.db.ws(ws='Sheet1').update_index(row=1, col=1, val='Sl-No')
-            self.db.ws(ws='Sheet1').update_index(row=1, col=2, val='MAC-ID')
-            self.db.ws(ws='Sheet1').update_index(row=1, col=3, val='Date')
-            self.db.ws(ws='Sheet1').update_index(row=1, col=4, val='File Name')
-            self._config.row_id = 2
-            print('File does not exists, creating new Exel')
-
-        # Column headings
-        # sl number in col 1
-        self.db.ws(ws='Sheet1').update_index(row=self._config.row_id, col=1, val=int(self._config.row_id - 1))
-        # mac address in col 2
-        self.db.ws(ws='Sheet1').update_index(row=self._config.row_id, col=2, val=mac_id)
-        # date in col 3
-        self.db.ws(ws='Sheet1').update_index(row=self._config.row_id, col=3, val=self.date)
-        # filename in col 4
-        self.db.ws(ws='Sheet1').update_index(row=self._config.row_id, col=4, val=file_name)
-        self._config.row_id += 1
-
-        # write out the db
-        xl.writexl(db=self.db, fn=Excel.path)
-        Excel.saved_data = f"{self._config.row_id - 2}, {mac_id}, {self.date}"
+    def save_data(self, mac_id, file_name, verify=None, verify_ms=None):
+        # one appended record, the Sl-No is allocated in the same transaction
+        with station_timings.span('', 'save'):
+            sl_no = self.store.append(mac_id, self.date, file_name, verify, verify_ms)
+
+        Excel.saved_data = f"{sl_no}, {mac_id}, {self.date}"
         print(f"\nExcel-saved: {Excel.saved_data}")
-        self._config.save()
+        return sl_no
+
+    def save_batch(self, records):
+        # (mac_id, file_name, verify, verify_ms) tuples, returns their Sl-Nos
+        with station_timings.span('', 'save'):
+            sl_nos = self.store.append_batch([(mac_id, self.date, file_name) + tuple(verify)
+                                              for mac_id, file_name, *verify in records])
+        for sl_no, (mac_id, *_) in zip(sl_nos, records):
+            Excel.saved_data = f"{sl_no}, {mac_id}, {self.date}"
+            print(f"Excel-saved: {Excel.saved_data}")
+        return sl_nos
+
+    def save_failure(self, error, file_name):
+        # a board that failed verification (flasher.VerifyError)
+        self.store.append_failure(error.mac, self.date, file_name, error.mode, error.verify_ms, str(error))
+        print(f"Verify failure saved: {error.mac}")
+
+    def export(self, path=None):
+        # writes the whole record log as a workbook (or .csv), on demand only;
+        # records are read from the store and written in chunks
+        path = path or Excel.path
+        rows = (row[1:] for row in self.store.rows(chunk=EXPORT_CHUNK))
+        if path.lower().endswith('.csv'):
+            count = write_csv(path, HEADINGS, rows)
+        else:
+            count = write_xlsx(path, HEADINGS, rows)
+        print(f"Exported {count} records to {path}")
+        return count
+
+
+def record_verify_failures(flash_func):
+    # wraps a GangFlasher flash_func, boards failing verification are logged
+    # from the worker thread before the error reaches the gang
+    def flash(config, port, progress=None, on_warning=None):
+        try:
+            return flash_func(config, port, progress=progress, on_warning=on_warning)
+        except VerifyError as e:
+            Excel().save_failure(e, os.path.basename(config.firmware_path))
+            raise
+    return flash
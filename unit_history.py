@@ -0,0 +1,47 @@
+import threading
+from record_store import RecordStore
+
+# printed before a board is written, the operator decides; the gang list,
+# station list and command line get check()'s list through the session
+WARNING_PREFIX = 'Warning: '
+
+
+class UnitHistory:
+    # checks a MAC against the record store and against the boards being
+    # flashed right now (by this process) as soon as it is read
+    def __init__(self):
+        self.path = None
+        self.store = None
+        self._flashing = {}
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        # path of the record store (.db), None to only look for duplicates in flight
+        self.path = path
+        self.store = RecordStore.open(path) if path else None
+
+    def check(self, mac, port):
+        warnings = []
+        with self._lock:
+            other = self._flashing.get(mac)
+            self._flashing[mac] = port
+        if other is not None and other != port:
+            warnings.append('MAC {} is also being flashed on {}, two boards with the same MAC?'.format(mac, other))
+        store = self.store
+        if store is not None:
+            records = store.find(mac=mac)
+            if records:
+                sl_no, _, day, file_name = records[0][:4]
+                warnings.append('{} was flashed {} time(s) before, last on {} with {} (Sl-No {})'.format(
+                    mac, len(records), day, file_name, sl_no))
+        for warning in warnings:
+            print(WARNING_PREFIX + warning)
+        return warnings
+
+    def release(self, port):
+        with self._lock:
+            for mac in [mac for mac, flashing in self._flashing.items() if flashing == port]:
+                del self._flashing[mac]
+
+
+unit_history = UnitHistory()